@@ -2,7 +2,23 @@
 import streamlit as st
 import pandas as pd
 import sqlite3
-import numpy as np
+import os
+import threading
+from collections import OrderedDict
+import partitions
+import prices
+import fare_calendar
+from dates import day_number
+import altair as alt
+
+DATA_FOLDER = "./logs/"
+# Shared by every session; least recently used results are dropped past this many bytes
+QUERY_CACHE_BYTES = 512 * 1024 * 1024
+# Rows shown in the results table; the query stops there instead of fetching the whole route
+DISPLAY_LIMIT = 1000
+# helper.SCHEMA_VERSION: the typed columns and flight_summary the queries below rely on. app.py
+# can't import helper (it pulls in the scraper), so older DBs are reported instead of migrated here
+SCHEMA_VERSION = 4
 
 domestic_city_pairs = [
     ["ATL","SEA"], 
@@ -31,45 +47,228 @@ intl_city_pairs = [
 ]
 intl_city = [i[1] for i in intl_city_pairs]
 
-def extract_price_and_currency(df):
-    # Use regex to extract currency symbol (assumes symbol is at the start)
-    df['currency'] = df['price'].str.extract(r'^([^\d]+)')  # non-digit characters at start
-    # Extract numeric part, handle empty strings after replacement
-    price_numeric = df['price'].str.replace(r'[^\d.]', '', regex=True)
-    # Replace empty strings with NaN explicitly
-    price_numeric = price_numeric.replace('', np.nan)
-    # Assign and convert safely
-    df['price_float'] = price_numeric.astype(float)
-    # Drop rows where conversion failed
-    df = df.dropna(subset=['price_float'])
-    df['departure_date'] = pd.to_datetime(df['departure_date'], errors='coerce')
-    df = df.dropna(subset=['departure_date'])
-    df['departure_date'] = pd.to_datetime(df['departure_date'], errors='coerce')
-    df = df.dropna(subset=['departure_date'])
-    return df
+# Columns the viewer shows or aggregates; prices and dates come from the typed columns
+# price_float is the price in prices.BASE_CURRENCY, converted in SQL with the local FX table
+BASE_PRICE = prices.base_price_sql()
+DISPLAY_COLUMNS = ["origin", "destination", "name", "days", "price", "currency", "price_minor", f"{BASE_PRICE} AS price_float",
+                   "today", "departure_date", "flight_duration", "flight_depart", "flight_arrive", "stops", "stops_info"]
+# flight_summary is maintained by helper at ingest time: one row per flight and departure date
+SUMMARY_COLUMNS = ["name", "departure_date", "flight_depart", "flight_arrive", "flight_duration", "stops", "days",
+                   f"{prices.base_price_sql('min_price_minor')} AS min_price", f"{prices.base_price_sql('max_price_minor')} AS max_price",
+                   f"{prices.base_price_sql('last_price_minor')} AS last_price", "obs_count"]
 
 
-# @st.cache_data()
-def load_df_from_db(db_path, origin=None, destination=None, max_price=None):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+def route_db_files(origin, destination, start_date=None, end_date=None):
+    # Partitioned storage once it has been backfilled: only the route's month files; otherwise the single DB per mode
+    mode = partitions.find_route_mode(DATA_FOLDER, origin, destination)
+    if mode is not None:
+        return partitions.find_partitions(DATA_FOLDER, mode, origin, destination, start_date, end_date)
+    if (origin=="ATL" and destination in dom_city) or (origin in dom_city and destination=="ATL"):
+        return [DATA_FOLDER + "dataDB_domestic.db"]
+    if (origin=="ATL" and destination in intl_city) or (origin in intl_city and destination=="ATL"):
+        return [DATA_FOLDER + "dataDB_intl.db"]
+    return []
+
+
+class QueryCache:
+    # LRU over query results with a memory budget. Frames are shared between sessions, so
+    # callers treat them as read-only
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, df):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return df
+        with self.lock:
+            if key in self.entries:
+                self.used -= self.entries.pop(key)[1]
+            self.entries[key] = (df, size)
+            self.used += size
+            while self.used > self.max_bytes:
+                self.used -= self.entries.popitem(last=False)[1][1]
+        return df
+
+
+@st.cache_resource
+def get_query_cache():
+    return QueryCache(QUERY_CACHE_BYTES)
+
+
+@st.cache_resource
+def get_connection(db_path, inode):
+    # One connection per DB file shared by all sessions; the inode is part of the key so a
+    # replaced file gets a fresh connection. The lock serializes use of the connection
+    return sqlite3.connect(db_path, check_same_thread=False), threading.Lock()
 
-    query = "SELECT * FROM data_table WHERE 1=1"
-    params = []
 
+def db_connection(db_path):
+    return get_connection(db_path, os.stat(db_path).st_ino)
+
+
+def outdated_db_files(db_paths):
+    # DB files whose PRAGMA user_version predates SCHEMA_VERSION
+    outdated = []
+    for db_path in db_paths:
+        conn, lock = db_connection(db_path)
+        with lock:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            outdated.append(db_path)
+    return outdated
+
+
+def cached_query(db_path, query, params=()):
+    # Keyed on the DB file, its on-disk state and the query; PRAGMA data_version changes whenever
+    # another connection (an ingest) commits, so stale results are never served
+    conn, lock = db_connection(db_path)
+    cache = get_query_cache()
+    with lock:
+        wal_path = db_path + "-wal"
+        mtime = (os.path.getmtime(db_path), os.path.getmtime(wal_path) if os.path.exists(wal_path) else None)
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        key = (db_path, mtime, data_version, query, tuple(params))
+        df = cache.get(key)
+        if df is None:
+            df = cache.put(key, pd.read_sql_query(query, conn, params=params))
+    return df
+
+
+def build_flight_query(origin=None, destination=None, min_price=None, max_price=None, start_date=None, end_date=None,
+                       max_stops=None, name=None, days=None, columns=DISPLAY_COLUMNS, table="data_table",
+                       price_column="price_minor", order_by="price_float", limit=None):
+    # Every sidebar filter becomes a parameterized predicate on an indexed or typed column
+    price = prices.base_price_sql(price_column)
+    query = f"SELECT {', '.join(columns)} FROM {table} WHERE {price_column} IS NOT NULL"
+    params = []
     if origin:
         query += " AND origin = ?"
         params.append(origin)
     if destination:
         query += " AND destination = ?"
         params.append(destination)
-    # if max_price:
-    #     query += " AND CAST(price AS FLOAT) <= ?"
-    #     params.append(max_price)
+    if start_date is not None:
+        query += " AND departure_day >= ?"
+        params.append(day_number(start_date))
+    if end_date is not None:
+        query += " AND departure_day <= ?"
+        params.append(day_number(end_date))
+    if min_price is not None:
+        query += f" AND {price} >= ?"
+        params.append(min_price)
+    if max_price is not None:
+        query += f" AND {price} <= ?"
+        params.append(max_price)
+    if max_stops is not None:
+        query += " AND stops_n <= ?"
+        params.append(int(max_stops))
+    if name is not None:
+        query += " AND name = ?"
+        params.append(name)
+    if days is not None:
+        query += " AND trip_days = ?"
+        params.append(int(days))
+    query += f" ORDER BY {order_by}"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(int(limit))
+    return query, params
+
+
+def build_summary_query(origin=None, destination=None, **filters):
+    # Same filters over flight_summary; the price range applies to each flight's cheapest fare
+    return build_flight_query(origin, destination, **filters, columns=SUMMARY_COLUMNS, table="flight_summary",
+                              price_column="min_price_minor", order_by="departure_date, flight_depart")
 
-    df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
-    return df
+
+def load_filter_bounds(db_paths, origin, destination):
+    # Slider and selectbox ranges from aggregate queries over the summary table, without moving any rows
+    bounds = {"min_price": None, "max_price": None, "min_date": None, "max_date": None, "max_stops": None,
+              "names": set(), "days": set()}
+    for db_path in db_paths:
+        min_price, max_price, min_date, max_date, max_stops = cached_query(db_path,
+            f"SELECT MIN({prices.base_price_sql('min_price_minor')}), MAX({prices.base_price_sql('max_price_minor')}), "
+            "MIN(departure_date), MAX(departure_date), MAX(stops_n) "
+            "FROM flight_summary WHERE origin = ? AND destination = ?", (origin, destination)).iloc[0].tolist()
+        if min_price is not None:
+            bounds["min_price"] = min_price if bounds["min_price"] is None else min(bounds["min_price"], min_price)
+            bounds["max_price"] = max_price if bounds["max_price"] is None else max(bounds["max_price"], max_price)
+            bounds["min_date"] = min_date if bounds["min_date"] is None else min(bounds["min_date"], min_date)
+            bounds["max_date"] = max_date if bounds["max_date"] is None else max(bounds["max_date"], max_date)
+            if max_stops is not None:
+                bounds["max_stops"] = max_stops if bounds["max_stops"] is None else max(bounds["max_stops"], max_stops)
+        bounds["names"].update(cached_query(db_path,
+            "SELECT DISTINCT name FROM flight_summary WHERE origin = ? AND destination = ? AND name IS NOT NULL", (origin, destination))["name"])
+        bounds["days"].update(int(days) for days in cached_query(db_path,
+            "SELECT DISTINCT trip_days FROM flight_summary WHERE origin = ? AND destination = ? AND trip_days IS NOT NULL", (origin, destination))["trip_days"])
+    if bounds["min_price"] is None:
+        return None
+    bounds["names"] = sorted(bounds["names"])
+    bounds["days"] = sorted(bounds["days"])
+    return bounds
+
+
+def query_db_files(db_paths, query, params, sort_by=None, limit=None):
+    # Runs the query on each file through the shared cache and merges the results, re-sorted on
+    # sort_by and cut to limit when several files contribute. The frame may be shared with other
+    # sessions through the query cache; don't modify it
+    if isinstance(db_paths, str):
+        db_paths = [db_paths]
+    frames = [cached_query(db_path, query, params) for db_path in db_paths]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0]
+    merged = pd.concat(frames, ignore_index=True)
+    if sort_by is not None:
+        merged = merged.sort_values(by=sort_by, kind="stable", ignore_index=True)
+    return merged if limit is None else merged.head(limit)
+
+
+def load_df_from_db(db_paths, origin=None, destination=None, limit=None, **filters):
+    # With a limit each file returns its cheapest rows and the merged result is cut to the same size
+    query, params = build_flight_query(origin, destination, **filters, limit=limit)
+    return query_db_files(db_paths, query, params, sort_by="price_float", limit=limit)
+
+
+def load_summary_from_db(db_paths, origin=None, destination=None, **filters):
+    # Indexed lookup in flight_summary instead of grouping the filtered rows
+    query, params = build_summary_query(origin, destination, **filters)
+    return query_db_files(db_paths, query, params, sort_by=["departure_date", "flight_depart"])
+
+
+def load_fare_calendar(db_paths, origin, destination, start_date=None, end_date=None, max_stops=None, name=None):
+    # Cheapest fare per departure date x trip length from flight_summary, through the shared cache
+    query, params = fare_calendar.cells_query(origin, destination, start_date, end_date, max_stops, name)
+    cells = query_db_files(db_paths, query, params)
+    if cells.empty:
+        return fare_calendar.fare_matrix([], [], [])
+    return fare_calendar.fare_matrix_from_frame(cells)
+
+
+def fare_calendar_chart(calendar):
+    cells = fare_calendar.fare_matrix_frame(calendar)
+    return alt.Chart(cells).mark_rect().encode(
+        x=alt.X("yearmonthdate(departure_date):O", title="Departure Date"),
+        y=alt.Y("days:O", title="Trip Length (days)"),
+        color=alt.Color("min_price:Q", title="Min Price", scale=alt.Scale(scheme="redyellowgreen", reverse=True)),
+        tooltip=[alt.Tooltip("departure_date:T"), "days:O", alt.Tooltip("min_price:Q", format=",.2f")],
+    )
 
 
 def main():
@@ -84,82 +283,73 @@ def main():
             st.error("Please enter both origin and destination.")
             return
     
-        if (origin=="ATL" and destination in dom_city) or (origin in dom_city and destination=="ATL"):
-            db_file = "./logs/dataDB_domestic.db"
-        elif (origin=="ATL" and destination in intl_city) or (origin in intl_city and destination=="ATL"):
-            db_file = "./logs/dataDB_intl.db"
-        else:
+        db_files = route_db_files(origin, destination)
+        if not db_files:
             print("Incorrect origin and destination")
             return
+        outdated = outdated_db_files(db_files)
+        if outdated:
+            st.error(f"{', '.join(outdated)} predates the current schema. Upgrade it from a notebook with "
+                     "helper.migrateDB(DB_filename, mode, folder_location), e.g. helper.migrateDB('dataDB', 'domestic', './logs/'), "
+                     "then load again.")
+            return
     
-        # max_price = st.sidebar.number_input("Max Price (optional)", min_value=0.0, value=0.0, step=10.0)
-        max_price = None
-    
-        with st.spinner("Querying database and loading DataFrame..."):
-            df = load_df_from_db(db_file, origin or None, destination or None, max_price or None)
+        with st.spinner("Querying database for filter ranges..."):
+            bounds = load_filter_bounds(db_files, origin, destination)
 
-            if df.empty:
+            if bounds is None:
                 st.warning("No data found for given parameters.")
                 return
-            
-        # with st.spinner("Preprocessing results"):
-            df = extract_price_and_currency(df)
-            st.success(f"Loaded {len(df)} rows.")
-            st.session_state.df = df
+
+            st.success(f"Found flights departing {bounds['min_date']} to {bounds['max_date']}.")
+            st.session_state.route = (origin, destination)
+            st.session_state.bounds = bounds
     
-    if 'df' in st.session_state:
-        df = st.session_state.df
+    if 'bounds' in st.session_state:
+        origin, destination = st.session_state.route
+        bounds = st.session_state.bounds
         with st.spinner("Populating filters"):
             st.sidebar.header("Post-load Filters")
-            min_price = float(df['price_float'].min())
-            max_price = float(df['price_float'].max())
-            min_date = df['departure_date'].min()
-            max_date = df['departure_date'].max()
-            unique_names = sorted(df['name'].dropna().unique().tolist())
-            unique_days = sorted(df['days'].dropna().unique().astype(int).tolist())
-        
-            unique_stops = sorted(df['stops'].dropna().unique().tolist())
-            numeric_stops = sorted({int(s) for s in unique_stops if str(s).isdigit()})
+            min_price = float(bounds['min_price'])
+            max_price = float(bounds['max_price'])
+            min_date = pd.to_datetime(bounds['min_date'])
+            max_date = pd.to_datetime(bounds['max_date'])
         
             with st.sidebar.form("filter_form"):
                 date_range = st.date_input("Departure Date Range", value=(min_date, max_date))
                 price_range = st.slider("Price Range", min_price, max_price, (min_price, max_price))
-                max_stops = st.slider("Max Stops", 0, max(numeric_stops) if numeric_stops else 3, 2)
-                name_selected = st.selectbox("Airline/Flight Name", options=["All"] + unique_names)
-                days_selected = st.selectbox("Trip Length (days)", options=["All"] + unique_days)
+                max_stops = st.slider("Max Stops", 0, bounds['max_stops'] if bounds['max_stops'] else 3, 2)
+                name_selected = st.selectbox("Airline/Flight Name", options=["All"] + bounds['names'])
+                days_selected = st.selectbox("Trip Length (days)", options=["All"] + bounds['days'])
                 apply_filters = st.form_submit_button("Apply Filters")
 
         if apply_filters:
             with st.spinner("Applying filters"):
-                filtered = df[
-                    (df['price_float'] >= price_range[0]) &
-                    (df['price_float'] <= price_range[1]) &
-                    (df['departure_date'] >= pd.to_datetime(date_range[0])) &
-                    (df['departure_date'] <= pd.to_datetime(date_range[1])) &
-                    (pd.to_numeric(df['stops'], errors='coerce') <= max_stops)
-                ]
-    
-                if name_selected != "All":
-                    filtered = filtered[filtered['name'] == name_selected]
-                if days_selected != "All":
-                    filtered = filtered[filtered['days'] == int(days_selected)]
-                filtered = filtered.sort_values(by="price_float", ascending=True)
-                st.session_state.filtered = filtered 
+                start_date, end_date = date_range if len(date_range) == 2 else (date_range[0], date_range[0])
+                # Only the filter values live in the session; the rows come from the shared cache
+                st.session_state.filters = dict(
+                    min_price=price_range[0], max_price=price_range[1], start_date=start_date, end_date=end_date,
+                    max_stops=max_stops,
+                    name=None if name_selected == "All" else name_selected,
+                    days=None if days_selected == "All" else days_selected,
+                )
+                db_files = route_db_files(origin, destination, start_date, end_date)
+                filtered = load_df_from_db(db_files, origin, destination, limit=DISPLAY_LIMIT, **st.session_state.filters)
                 
                 st.subheader("Filtered Flight Results")
-                filtered['departure_date'] = filtered['departure_date'].dt.strftime("%Y-%m-%d")
-                st.dataframe(filtered.head(1000), use_container_width=True)
-
-                flight_summary = (
-                    filtered.groupby(['name','departure_date', 'flight_depart', 'flight_arrive', 'flight_duration','stops','days'])
-                    .agg(min_price=('price_float', 'min'), max_price=('price_float', 'max'))
-                    .reset_index()
-                    .sort_values(by=['departure_date', 'flight_depart'])
-                )
+                st.dataframe(filtered, use_container_width=True)
+
+                flight_summary = load_summary_from_db(db_files, origin, destination, **st.session_state.filters)
 
                 st.subheader("Flight Price Summary (Min and Max)")
                 st.dataframe(flight_summary, use_container_width=True)
 
+                calendar = load_fare_calendar(db_files, origin, destination, start_date, end_date,
+                                              st.session_state.filters["max_stops"], st.session_state.filters["name"])
+                if calendar.grid.size:
+                    st.subheader("Fare Calendar (Cheapest by Departure Date and Trip Length)")
+                    st.altair_chart(fare_calendar_chart(calendar), use_container_width=True)
+
         else:
             st.info("Use the sidebar to load data.")
         
@@ -0,0 +1,18 @@
+import datetime
+import functools
+
+#dates are stored as day numbers since EPOCH_DATE (departure_day, snapshot_day, ...). Kept
+#free of other imports so helper (ingest), app.py and fare_calendar can all share it
+EPOCH_DATE = datetime.date(1970, 1, 1)
+
+@functools.lru_cache(maxsize=None)
+def day_number(date):
+    #'2026-03-14', a date or a Timestamp -> days since EPOCH_DATE; None if it can't be parsed
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    elif not isinstance(date, datetime.date):
+        try:
+            date = datetime.date.fromisoformat(str(date))
+        except ValueError:
+            return None
+    return (date - EPOCH_DATE).days
@@ -0,0 +1,69 @@
+import sqlite3
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import prices
+from dates import day_number
+
+#cheapest fare per (departure date, trip length) for a route, as a dense grid built from the
+#flight_summary table helper maintains at ingest. Each summary row already holds one flight's
+#min price, so building the grid is a single scatter-min over those rows
+FareCalendar = namedtuple("FareCalendar", ["dates", "durations", "grid"])
+
+def cells_query(origin, destination, start_date=None, end_date=None, max_stops=None, name=None):
+    query = (f"SELECT departure_day, trip_days, {prices.base_price_sql('min_price_minor')} AS price FROM flight_summary "
+             "WHERE origin = ? AND destination = ? AND min_price_minor IS NOT NULL")
+    params = [origin, destination]
+    if start_date is not None:
+        query += " AND departure_day >= ?"
+        params.append(day_number(start_date))
+    if end_date is not None:
+        query += " AND departure_day <= ?"
+        params.append(day_number(end_date))
+    if max_stops is not None:
+        query += " AND stops_n <= ?"
+        params.append(int(max_stops))
+    if name is not None:
+        query += " AND name = ?"
+        params.append(name)
+    return query, params
+
+def fare_matrix(departure_day, trip_days, price, durations=None):
+    #rows are every day from the first to the last departure, columns the trip lengths (those seen
+    #in the data unless durations is given); empty cells are NaN
+    departure_day = np.asarray(departure_day, dtype=np.int64)
+    trip_days = np.asarray(trip_days, dtype=np.int64)
+    price = np.asarray(price, dtype=float)
+    durations = np.unique(trip_days) if durations is None else np.unique(np.asarray(durations, dtype=np.int64))
+    if len(departure_day)==0 or len(durations)==0:
+        return FareCalendar(np.array([], dtype='datetime64[D]'), durations, np.empty((0, len(durations))))
+    first_day = departure_day.min()
+    dates = np.arange(first_day, departure_day.max()+1).astype('datetime64[D]')
+    cols = np.searchsorted(durations, trip_days)
+    keep = (cols < len(durations)) & (durations[np.minimum(cols, len(durations)-1)] == trip_days) & ~np.isnan(price)
+    grid = np.full((len(dates), len(durations)), np.inf)
+    np.minimum.at(grid, (departure_day[keep]-first_day, cols[keep]), price[keep])
+    grid[np.isinf(grid)] = np.nan
+    return FareCalendar(dates, durations, grid)
+
+def fare_matrix_from_frame(cells, durations=None):
+    #cells as returned by cells_query, eg through a cached read_sql_query
+    return fare_matrix(cells["departure_day"].to_numpy(), cells["trip_days"].to_numpy(), cells["price"].to_numpy(), durations)
+
+def load_fare_matrix(db_paths, origin, destination, start_date=None, end_date=None, durations=None, **filters):
+    if isinstance(db_paths, str):
+        db_paths = [db_paths]
+    query, params = cells_query(origin, destination, start_date, end_date, **filters)
+    rows = []
+    for db_path in db_paths:
+        conn = sqlite3.connect(db_path)
+        rows.extend(conn.execute(query, params).fetchall())
+        conn.close()
+    cells = np.array(rows, dtype=float).reshape(-1, 3)
+    return fare_matrix(cells[:, 0], cells[:, 1], cells[:, 2], durations)
+
+def fare_matrix_frame(calendar):
+    #long format (departure_date, days, min_price) of the filled cells, for plotting
+    rows, cols = np.nonzero(~np.isnan(calendar.grid))
+    return pd.DataFrame({"departure_date": calendar.dates[rows], "days": calendar.durations[cols],
+                         "min_price": calendar.grid[rows, cols]})
@@ -3,6 +3,9 @@ import datetime
 import pickle
 import random
 from fast_flights import FlightData, Passengers, create_filter, get_flights, Bags
+from fast_flights.core import parse_response
+import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 import os.path
 import time
@@ -12,16 +15,66 @@ from tqdm.notebook import tqdm
 from os import listdir
 from os.path import isfile, join
 import sqlite3
+import re
+import functools
+import asyncio
+import threading
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import queue
+import zlib
+import uuid
+import heapq
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+from itertools import repeat, islice
+import socket
+import partitions
+import prices
+from prices import parse_price
+from dates import EPOCH_DATE, day_number
 
 PROCESS_STR="Learn more"
 LOWERCASE_STR="abcdefghijklmnopqrstuvwxyz"
 UPPERCASE_STR = LOWERCASE_STR.upper()
 EXCEPT_LIST = ["easy, Jet", "Jet, Blue", "West, Jet"]
 replace_dict = {"easy, Jet":"easyJet", "Jet, Blue":"JetBlue", "West, Jet":"WestJet"}
+#the GET fast_flights' get_flights sends (a plain requests.get with the consent cookie),
+#reproduced over a pooled session in get_flights_wrapper
+FLIGHTS_URL = "https://www.google.com/travel/flights"
+CONSENT_COOKIES = { "CONSENT": "YES+" }
 dict_cats = ["origin","destination","name","days","price","today",\
              "days ahead","flight duration","flight depart","flight arrive","stops","stops info","departure date"]
 sql_cats = ["origin","destination","name","days","price","today",\
              "days_ahead","flight_duration","flight_depart","flight_arrive","stops","stops_info","departure_date"]
+#v2 columns, parsed once at ingest from the text ones: price in minor units + ISO currency,
+#dates as day numbers since 1970-01-01, duration in minutes, stops and trip length as integers
+typed_cats = ["price_minor","currency","departure_day","snapshot_day","duration_min","stops_n","trip_days"]
+SCHEMA_VERSION = 4
+#one observation: a route/date/trip length, one airline's departure and arrival, seen on one snapshot day.
+#v3 makes it unique and ingest upserts on it, so re-running a day or overlapping samples
+#overwrite the stored row instead of adding a copy
+NATURAL_KEY = ("origin","destination","departure_date","days","name","flight_depart","flight_arrive","today")
+INSERT_QUERY = f"INSERT INTO data_table ({', '.join(sql_cats+typed_cats)}, source_id) VALUES ({', '.join(['?']*(len(sql_cats)+len(typed_cats)+1))})" \
+    f" ON CONFLICT ({', '.join(NATURAL_KEY)}) DO UPDATE SET " \
+    + ', '.join(f"{c}=excluded.{c}" for c in sql_cats+typed_cats+["source_id"] if c not in NATURAL_KEY)
+#applied when loading pickles into the DB; WAL + synchronous=NORMAL is safe against crashes
+#and much cheaper than the default full sync, cache_size is in KiB when negative
+INGEST_PRAGMAS = {"journal_mode": "WAL", "synchronous": "NORMAL", "cache_size": -65536}
+INGEST_BATCH_SIZE = 50000
+#route loads filter on origin/destination/departure_date, which the natural key index leads with;
+#the second index carries the typed price so the min-price-per-date summary is answered from
+#the index alone
+DATA_TABLE_UNIQUE_INDEXES = {
+    "idx_data_natural_key": NATURAL_KEY,
+}
+DATA_TABLE_INDEXES = {
+    "idx_data_route_day_price": ("origin", "destination", "departure_day", "trip_days", "price_minor", "snapshot_day"),
+}
+ANALYSIS_LIMIT = 1000
 
 def createInitialDBTable(cursor):
     create_table_query = '''
@@ -39,30 +92,293 @@ def createInitialDBTable(cursor):
         flight_arrive TEXT,
         stops TEXT,
         stops_info TEXT,
-        departure_date TEXT
+        departure_date TEXT,
+        source_id INTEGER,
+        price_minor INTEGER,
+        currency TEXT,
+        departure_day INTEGER,
+        snapshot_day INTEGER,
+        duration_min INTEGER,
+        stops_n INTEGER,
+        trip_days INTEGER
     )
     '''    
     cursor.execute(create_table_query)
+    cursor = createIngestManifest(cursor)
+    cursor = migrateDataTable(cursor)
+    cursor = createDataTableIndexes(cursor)
     return cursor
-    
 
-def addDictToDB(itin_dict, cursor):
-    #assumes that the DB is already created
+def createDataTableIndexes(cursor):
+    for index_name, columns in DATA_TABLE_UNIQUE_INDEXES.items():
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON data_table ({', '.join(columns)})")
+    for index_name, columns in DATA_TABLE_INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON data_table ({', '.join(columns)})")
+    return cursor
+
+def analyzeDB(cursor):
+    #refresh planner statistics after a load; analysis_limit samples each index instead of
+    #scanning the whole table, so this stays cheap as history accumulates
+    cursor.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    cursor.execute("ANALYZE")
+    return cursor
+
+def explainQueryPlan(DB_filename, mode, folder_location, query, params=(), verbose=True):
+    #returns the EXPLAIN QUERY PLAN detail lines and the indexes they use
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
+    plan = [row[3] for row in cursor.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()]
+    conn.close()
+    known = set(DATA_TABLE_INDEXES) | set(DATA_TABLE_UNIQUE_INDEXES) | set(FLIGHT_SUMMARY_UNIQUE_INDEXES) | set(FLIGHT_SUMMARY_INDEXES)
+    indexes = sorted({word for line in plan for word in line.split() if word in known or word.startswith("sqlite_autoindex")})
+    if verbose:
+        for line in plan:
+            print(line)
+    return plan, indexes
+
+def createIngestManifest(cursor):
+    #one row per loaded source file (size, mtime, content hash, rows produced); data_table.source_id
+    #points back at it so a changed file can swap out exactly its own rows
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_manifest (
+        id INTEGER PRIMARY KEY,
+        file_name TEXT UNIQUE,
+        size INTEGER,
+        mtime REAL,
+        content_hash TEXT,
+        row_count INTEGER,
+        ingested_at TEXT
+    )
+    ''')
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(data_table)").fetchall()]
+    if "source_id" not in columns:
+        #DBs created before the manifest existed
+        cursor.execute("ALTER TABLE data_table ADD COLUMN source_id INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_data_table_source ON data_table (source_id)")
+    return cursor
+
+DURATION_RE = re.compile(r'^\s*(?:(\d+)\s*hr?s?)?\s*(?:(\d+)\s*min)?\s*$')
+@functools.lru_cache(maxsize=None)
+def duration_minutes(duration):
+    m = DURATION_RE.match(str(duration))
+    if m is None or (m.group(1) is None and m.group(2) is None):
+        return None
+    return int(m.group(1) or 0)*60 + int(m.group(2) or 0)
+
+def stops_number(stops):
+    try:
+        return int(stops)
+    except (TypeError, ValueError):
+        return None
+
+def trip_days_number(days):
+    #one-way (domestic) rows have days=='' and count as 0
+    try:
+        return int(days)
+    except (TypeError, ValueError):
+        return 0
+
+def typedFields(row):
+    #row is in sql_cats order
+    price_minor, currency = parse_price(row[4])
+    return (price_minor, currency, day_number(row[12]), day_number(row[5]), duration_minutes(row[7]),
+            stops_number(row[10]), trip_days_number(row[3]))
+
+def registerParseFunctions(conn):
+    conn.create_function("price_minor_of", 1, lambda price: parse_price(price)[0], deterministic=True)
+    conn.create_function("currency_of", 1, lambda price: parse_price(price)[1], deterministic=True)
+    conn.create_function("day_number", 1, day_number, deterministic=True)
+    conn.create_function("duration_minutes", 1, duration_minutes, deterministic=True)
+    conn.create_function("stops_number", 1, stops_number, deterministic=True)
+    conn.create_function("trip_days_number", 1, trip_days_number, deterministic=True)
+
+def migrateDataTable(cursor):
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < 2:
+        cursor = migrateTypedColumns(cursor)
+    if version < 3:
+        #the unique index can only be built once the duplicates are gone
+        dedupeDataTable(cursor)
+        cursor.execute("DROP INDEX IF EXISTS idx_data_route_date")
+        createDataTableIndexes(cursor)
+    if version < 4:
+        createFlightSummary(cursor)
+        rebuildFlightSummary(cursor)
+    cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return cursor
+
+#flight_summary holds min/max/last price and the observation count for every flight on every
+#departure date, kept current by triggers on data_table: a new observation is folded in directly,
+#while a changed or deleted one recomputes just its own key through the natural key index (which
+#the summary key is a prefix of, plus stops). Rows without a parsed price are left out
+SUMMARY_KEY = ("origin","destination","departure_date","days","name","flight_depart","flight_arrive","stops")
+SUMMARY_PAYLOAD = ("departure_day","trip_days","stops_n","flight_duration")
+SUMMARY_COLUMNS = SUMMARY_KEY + SUMMARY_PAYLOAD + ("min_price_minor","max_price_minor","last_price_minor","currency","last_seen_day","obs_count")
+FLIGHT_SUMMARY_UNIQUE_INDEXES = {
+    "idx_flight_summary_key": SUMMARY_KEY,
+}
+FLIGHT_SUMMARY_INDEXES = {
+    "idx_flight_summary_route_day": ("origin", "destination", "departure_day", "trip_days"),
+}
+
+def summarySelect(where):
+    #the summary rows for the data_table rows matching where, last price taken from the latest snapshot
+    return f'''
+    SELECT {', '.join(SUMMARY_KEY)}, MAX(CASE WHEN rn=1 THEN departure_day END), MAX(CASE WHEN rn=1 THEN trip_days END),
+        MAX(CASE WHEN rn=1 THEN stops_n END), MAX(CASE WHEN rn=1 THEN flight_duration END),
+        MIN(price_minor), MAX(price_minor), MAX(CASE WHEN rn=1 THEN price_minor END), MAX(CASE WHEN rn=1 THEN currency END),
+        MAX(snapshot_day), COUNT(*)
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY {', '.join(SUMMARY_KEY)} ORDER BY snapshot_day DESC, id DESC) AS rn
+        FROM data_table WHERE price_minor IS NOT NULL AND {where}
+    )
+    GROUP BY {', '.join(SUMMARY_KEY)}
+    '''
+
+def createFlightSummary(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS flight_summary (
+        origin TEXT,
+        destination TEXT,
+        departure_date TEXT,
+        days INTEGER,
+        name TEXT,
+        flight_depart TEXT,
+        flight_arrive TEXT,
+        stops TEXT,
+        departure_day INTEGER,
+        trip_days INTEGER,
+        stops_n INTEGER,
+        flight_duration TEXT,
+        min_price_minor INTEGER,
+        max_price_minor INTEGER,
+        last_price_minor INTEGER,
+        currency TEXT,
+        last_seen_day INTEGER,
+        obs_count INTEGER
+    )
+    ''')
+    for index_name, columns in FLIGHT_SUMMARY_UNIQUE_INDEXES.items():
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON flight_summary ({', '.join(columns)})")
+    for index_name, columns in FLIGHT_SUMMARY_INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON flight_summary ({', '.join(columns)})")
+    def recompute(row):
+        key = ' AND '.join(f"{c} = {row}.{c}" for c in SUMMARY_KEY)
+        return f'''
+        DELETE FROM flight_summary WHERE {key};
+        INSERT INTO flight_summary ({', '.join(SUMMARY_COLUMNS)}) {summarySelect(key)};
+        '''
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flight_summary_insert AFTER INSERT ON data_table WHEN new.price_minor IS NOT NULL
+    BEGIN
+        INSERT INTO flight_summary ({', '.join(SUMMARY_COLUMNS)})
+        VALUES ({', '.join('new.'+c for c in SUMMARY_KEY+SUMMARY_PAYLOAD)}, new.price_minor, new.price_minor, new.price_minor,
+                new.currency, new.snapshot_day, 1)
+        ON CONFLICT ({', '.join(SUMMARY_KEY)}) DO UPDATE SET
+            min_price_minor = MIN(min_price_minor, excluded.min_price_minor),
+            max_price_minor = MAX(max_price_minor, excluded.max_price_minor),
+            {', '.join(f"{c} = CASE WHEN excluded.last_seen_day >= last_seen_day THEN excluded.{c} ELSE {c} END" for c in SUMMARY_PAYLOAD+("last_price_minor","currency"))},
+            last_seen_day = MAX(last_seen_day, excluded.last_seen_day),
+            obs_count = obs_count + 1;
+    END
+    ''')
+    #an upsert that hits an existing observation runs the UPDATE triggers, not the INSERT one; stops
+    #is in the summary key but not the natural key, so the row may move between summary keys
+    changed = ' OR '.join(f"old.{c} IS NOT new.{c}" for c in ("price_minor","currency","snapshot_day","stops","flight_duration"))
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flight_summary_update AFTER UPDATE ON data_table WHEN {changed}
+    BEGIN {recompute('old')} {recompute('new')} END
+    ''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS flight_summary_delete AFTER DELETE ON data_table WHEN old.price_minor IS NOT NULL
+    BEGIN {recompute('old')} END
+    ''')
+    return cursor
+
+def rebuildFlightSummary(cursor):
+    cursor.execute("DELETE FROM flight_summary")
+    cursor.execute(f"INSERT INTO flight_summary ({', '.join(SUMMARY_COLUMNS)}) {summarySelect('1')}")
+    return cursor
+
+def dedupeDataTable(cursor):
+    #keeps the most recently inserted row of each natural key, returns how many were removed
+    cursor.execute(f'''
+    DELETE FROM data_table WHERE id NOT IN (
+        SELECT MAX(id) FROM data_table GROUP BY {', '.join(NATURAL_KEY)}
+    )
+    ''')
+    return cursor.rowcount
+
+def migrateTypedColumns(cursor):
+    #v1 -> v2: add the typed columns and fill them from the text ones in one UPDATE
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(data_table)").fetchall()]
+    for column, column_type in zip(typed_cats, ["INTEGER","TEXT","INTEGER","INTEGER","INTEGER","INTEGER","INTEGER"]):
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE data_table ADD COLUMN {column} {column_type}")
+    registerParseFunctions(cursor.connection)
+    cursor.execute('''
+    UPDATE data_table SET
+        price_minor = price_minor_of(price),
+        currency = currency_of(price),
+        departure_day = day_number(departure_date),
+        snapshot_day = day_number(today),
+        duration_min = duration_minutes(flight_duration),
+        stops_n = stops_number(stops),
+        trip_days = trip_days_number(days)
+    ''')
+    return cursor
+
+def migrateDB(DB_filename, mode, folder_location):
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
+    cursor = createInitialDBTable(cursor)
+    closeDB(conn, cursor)
+
+def itinRows(itin_dict):
+    #transposes every filled itinerary into row tuples in sql_cats order
     for outer_key, inner_dict in itin_dict.items():
         if isEmpty(inner_dict):
             continue
-        num_rows = len(inner_dict["origin"])
-        for i in range(num_rows):  
-            row = []
-            for inner_key, values in inner_dict.items():
-                row.append(values[i])
-            # Insert the row into the table (excluding the id column)
-            insert_query = f"INSERT INTO data_table ({', '.join(sql_cats)}) VALUES ({', '.join(['?']*len(dict_cats))})"
-            cursor.execute(insert_query, row)
+        if isinstance(inner_dict, FlightColumns):
+            yield from inner_dict.rows()
+        else:
+            yield from zip(*[inner_dict[cat] for cat in dict_cats])
+
+def typedRows(rows):
+    #sql_cats rows -> sql_cats+typed_cats rows, everything but source_id ready for INSERT_QUERY
+    for row in rows:
+        yield row + typedFields(row)
+
+def insertRows(cursor, rows, batch_size=INGEST_BATCH_SIZE, source_id=None, parsed=False):
+    #rows go in with executemany in batches of batch_size inside the caller's transaction; with
+    #parsed the rows already carry their typed fields (typedRows). Returns the number of rows inserted
+    num_rows = 0
+    rows = iter(rows)
+    while True:
+        if parsed:
+            batch = [row + (source_id,) for row in islice(rows, batch_size)]
+        else:
+            batch = [row + typedFields(row) + (source_id,) for row in islice(rows, batch_size)]
+        if len(batch)==0:
+            break
+        cursor.executemany(INSERT_QUERY, batch)
+        num_rows += len(batch)
+    return num_rows
+
+def bulkAddDictToDB(itin_dict, cursor, batch_size=INGEST_BATCH_SIZE, source_id=None):
+    #assumes that the DB is already created
+    return insertRows(cursor, itinRows(itin_dict), batch_size, source_id)
+
+def addDictToDB(itin_dict, cursor, batch_size=INGEST_BATCH_SIZE):
+    bulkAddDictToDB(itin_dict, cursor, batch_size)
     return cursor
 
-def returnDBFromFile(DB_filename, mode, folder_location):
+def configureDB(conn, pragmas):
+    for pragma, value in pragmas.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+
+def returnDBFromFile(DB_filename, mode, folder_location, pragmas=None):
     conn = sqlite3.connect(folder_location+DB_filename+'_'+mode+'.db')
+    if pragmas:
+        configureDB(conn, pragmas)
     cursor = conn.cursor()
     return conn, cursor
 
@@ -70,50 +386,356 @@ def closeDB(conn, cursor):
     conn.commit()
     conn.close()    
 
-def addDictToDBFromFile(DB_filename, mode, folder_location, itin_dict):
-    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
-    cursor = addDictToDB(itin_dict, cursor)
-    closeDB(conn, cursor)
+def fileSignature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
 
-def createDBFromDictFiles(DB_filename, mode, folder_location):
-    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
+def sourceSignature(folder_location, source_name, itin_dict):
+    #(size, mtime, content_hash) of the day file; a dict that was never saved has no size/mtime
+    #and is hashed from its pickled form
+    path = folder_location+source_name
+    if not os.path.isfile(path):
+        return None, None, hashlib.sha256(pickle.dumps(itin_dict, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+    size, mtime = fileSignature(path)
+    with open(path, 'rb') as handle:
+        return size, mtime, hashlib.sha256(handle.read()).hexdigest()
+
+def manifestEntry(cursor, file_name):
+    return cursor.execute("SELECT id, size, mtime, content_hash FROM ingest_manifest WHERE file_name=?", (file_name,)).fetchone()
+
+def isSourceUnchanged(entry, size, mtime):
+    return entry is not None and entry[1]==size and entry[2]==mtime
+
+def replaceSourceRows(conn, cursor, file_name, size, mtime, content_hash, rows, batch_size=INGEST_BATCH_SIZE, parsed=False):
+    #loads one source's rows in its own transaction, replacing whatever it produced before.
+    #Returns the rows inserted, or None when the same content is already loaded
+    entry = manifestEntry(cursor, file_name)
+    if entry is not None and entry[3]==content_hash:
+        cursor.execute("UPDATE ingest_manifest SET size=?, mtime=? WHERE id=?", (size, mtime, entry[0]))
+        conn.commit()
+        return None
+    if entry is None:
+        cursor.execute("INSERT INTO ingest_manifest (file_name) VALUES (?)", (file_name,))
+        source_id = cursor.lastrowid
+    else:
+        source_id = entry[0]
+        cursor.execute("DELETE FROM data_table WHERE source_id=?", (source_id,))
+    num_rows = insertRows(cursor, rows, batch_size, source_id, parsed)
+    cursor.execute("UPDATE ingest_manifest SET size=?, mtime=?, content_hash=?, row_count=?, ingested_at=? WHERE id=?",
+                   (size, mtime, content_hash, num_rows, datetime.datetime.now().isoformat(timespec='seconds'), source_id))
+    conn.commit()
+    return num_rows
+
+#source_name is the day's pickle (eg date_today_file); when given the load is recorded in the
+#manifest, so calling this twice for the same day, or backfilling that file later, does not
+#duplicate rows. Without it rows are appended untracked like before
+def addDictToDBFromFile(DB_filename, mode, folder_location, itin_dict, source_name=None, pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    start = time.time()
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location, pragmas)
     cursor = createInitialDBTable(cursor)
+    if source_name is None:
+        num_rows = bulkAddDictToDB(itin_dict, cursor, batch_size)
+    else:
+        size, mtime, content_hash = sourceSignature(folder_location, source_name, itin_dict)
+        num_rows = replaceSourceRows(conn, cursor, source_name, size, mtime, content_hash, itinRows(itin_dict), batch_size)
+    if num_rows:
+        analyzeDB(cursor)
+    closeDB(conn, cursor)
+    if num_rows is None:
+        print(source_name, "already loaded, nothing to add")
+        return 0
+    elapsed = time.time() - start
+    print(num_rows, "rows added in", round(elapsed, 2), "s (", int(num_rows/max(elapsed, 1e-9)), "rows/sec )")
+    return num_rows
+
+def dictFiles(folder_location, mode):
     files = [f for f in listdir(folder_location) if isfile(join(folder_location, f))]
     if mode=='intl':
-        files = [f for f in files if mode in f and '.pkl' in f]
+        files = [f for f in files if mode in f and f.endswith('.pkl')]
     else:
-        files = [f for f in files if 'intl' not in f and '.pkl' in f]
+        files = [f for f in files if 'intl' not in f and f.endswith('.pkl')]
+    return files
+
+def createDBFromDictFiles(DB_filename, mode, folder_location, pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    start = time.time()
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location, pragmas)
+    cursor = createInitialDBTable(cursor)
+    files = dictFiles(folder_location, mode)
     progress_bar = tqdm(total=len(files), desc='Processing Files')
     i=1
+    num_rows=0
+    num_loaded=0
+    #files whose size/mtime (or failing that, content hash) match the manifest are skipped;
+    #new or changed files are loaded in their own transaction
     for f in files:
         progress_bar.n = i
         progress_bar.refresh()
-        with open(folder_location+f, 'rb') as handle:
-            itin_dict = pickle.load(handle) 
-            cursor = addDictToDB(itin_dict, cursor)
         i+=1
+        size, mtime = fileSignature(folder_location+f)
+        if isSourceUnchanged(manifestEntry(cursor, f), size, mtime):
+            continue
+        with open(folder_location+f, 'rb') as handle:
+            data = handle.read()
+        itin_dict = pickle.loads(data)
+        file_rows = replaceSourceRows(conn, cursor, f, size, mtime, hashlib.sha256(data).hexdigest(), itinRows(itin_dict), batch_size)
+        if file_rows is not None:
+            num_rows += file_rows
+            num_loaded+=1
+        progress_bar.set_postfix_str(f'{int(num_rows/max(time.time()-start, 1e-9))} rows/sec')
+    progress_bar.close()
+    if num_rows:
+        analyzeDB(cursor)
     # Commit the changes and close the connection
     closeDB(conn, cursor)
+    elapsed = time.time() - start
+    print(num_rows, "rows loaded from", num_loaded, "new or changed files (", len(files)-num_loaded, "unchanged ) in", round(elapsed, 2), "s (", int(num_rows/max(elapsed, 1e-9)), "rows/sec )")
+    return num_rows
     
 
-def getAllFlightData(origin, destination, folder_location, exclusion_list):
-    files = [f for f in listdir(folder_location) if isfile(join(folder_location, f))]
-    files = [f for f in files if f not in exclusion_list]
-    aggregateDf = pd.DataFrame()
-    city_prefix1 = '_'.join([origin, destination])
-    city_prefix2 = '_'.join([destination, origin])
+def decodeDictFile(path):
+    #runs in a worker process: hash and unpickle one day's file, flatten it and parse the typed
+    #fields, so the writer only has to add source_id
+    size, mtime = fileSignature(path)
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    itin_dict = pickle.loads(data)
+    return size, mtime, hashlib.sha256(data).hexdigest(), list(typedRows(itinRows(itin_dict)))
+
+#parallel backfill: a process pool unpickles, flattens and parses files while a single writer
+#thread streams the ready row batches into SQLite. At most num_workers+queue_size files are submitted at a
+#time and a new one only as one finishes, so with the bounded queue decoded files can't pile up
+#in memory when the writer falls behind
+def createDBFromDictFilesParallel(DB_filename, mode, folder_location, num_workers=None, queue_size=4,
+                                  pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    start = time.time()
+    #unchanged files (per the manifest) are dropped before any decoding happens
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location, pragmas)
+    createInitialDBTable(cursor)
+    conn.commit()
+    all_files = dictFiles(folder_location, mode)
+    files = [f for f in all_files if not isSourceUnchanged(manifestEntry(cursor, f), *fileSignature(folder_location+f))]
+    conn.close()
+    row_queue = queue.Queue(maxsize=queue_size)
+    metrics = {"num_rows": 0, "num_files": 0, "write_time": 0.0, "error": None}
+    pool = ProcessPoolExecutor(max_workers=num_workers)
+    pending = iter(files)
+    futures = {}
+
+    def submit_next():
+        f = next(pending, None)
+        if f is not None:
+            futures[pool.submit(decodeDictFile, folder_location+f)] = f
+
+    #the first window is submitted, and so every worker forked, before the writer thread and the
+    #progress bar start; forking a process that already runs other threads can deadlock it
+    for _ in range(num_workers + queue_size):
+        submit_next()
+    progress_bar = tqdm(total=len(files), desc='Processing Files')
+
+    def writer():
+        conn, cursor = returnDBFromFile(DB_filename, mode, folder_location, pragmas)
+        try:
+            while True:
+                item = row_queue.get()
+                if item is None:
+                    break
+                f, size, mtime, content_hash, rows = item
+                write_start = time.time()
+                file_rows = replaceSourceRows(conn, cursor, f, size, mtime, content_hash, rows, batch_size, parsed=True)
+                metrics["write_time"] += time.time() - write_start
+                if file_rows is not None:
+                    metrics["num_rows"] += file_rows
+                    metrics["num_files"] += 1
+                progress_bar.update(1)
+                progress_bar.set_postfix_str(f'{int(metrics["num_rows"]/max(time.time()-start, 1e-9))} rows/sec, queue {row_queue.qsize()}')
+            if metrics["num_rows"]:
+                analyzeDB(cursor)
+            closeDB(conn, cursor)
+        except Exception as e:
+            metrics["error"] = e
+            conn.close()
+            #keep draining so the producer never blocks on a dead writer
+            while row_queue.get() is not None:
+                pass
+
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    try:
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                #popped so the decoded rows are only referenced by the queue from here on
+                f = futures.pop(future)
+                row_queue.put((f,) + future.result())
+                submit_next()
+    except BaseException:
+        #a bad pickle shouldn't wait for every decode still queued in the pool
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    finally:
+        row_queue.put(None)
+        writer_thread.join()
+        pool.shutdown(wait=True)
+        progress_bar.close()
+    if metrics["error"] is not None:
+        raise metrics["error"]
+    elapsed = time.time() - start
+    print(metrics["num_rows"], "rows loaded from", metrics["num_files"], "new or changed files (", len(all_files)-metrics["num_files"], "unchanged ) in", round(elapsed, 2), "s (",
+          int(metrics["num_rows"]/max(elapsed, 1e-9)), "rows/sec,", round(metrics["write_time"], 2), "s writing )")
+    return metrics["num_rows"]
+
+#partitioned storage: the same data_table schema split into one file per route and departure
+#month (layout and catalog live in partitions.py). Each source file is split by partition and
+#the partitions are written concurrently, one connection per file, while the catalog is only
+#touched from the calling thread
+def splitRowsByPartition(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault((row[0], row[1], partitions.partition_month(row[12])), []).append(row)
+    return groups
+
+def writePartition(folder_location, mode, key, rows, file_name, size, mtime, content_hash,
+                   pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    path = partitions.partition_name(*key)
+    full_path = join(partitions.partition_root(folder_location, mode), path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    conn = sqlite3.connect(full_path, timeout=60)
+    configureDB(conn, pragmas)
+    cursor = createInitialDBTable(conn.cursor())
+    file_rows = replaceSourceRows(conn, cursor, file_name, size, mtime, content_hash, rows, batch_size)
+    if file_rows:
+        analyzeDB(cursor)
+    row_count, min_date, max_date = cursor.execute("SELECT COUNT(*), MIN(departure_date), MAX(departure_date) FROM data_table").fetchone()
+    closeDB(conn, cursor)
+    return path, key, file_rows or 0, row_count, min_date, max_date
+
+def writeSourceToPartitions(catalog, folder_location, mode, file_name, size, mtime, content_hash, rows,
+                            num_workers=4, pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    groups = splitRowsByPartition(rows)
+    jobs = {partitions.partition_name(*key): (key, key_rows) for key, key_rows in groups.items()}
+    #months the file covered last time but not any more still hold its old rows; an empty write clears them
+    for path, key in partitions.source_partition_keys(catalog, file_name).items():
+        jobs.setdefault(path, (key, []))
+    num_rows = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(writePartition, folder_location, mode, key, key_rows, file_name, size, mtime, content_hash, pragmas, batch_size)
+                   for key, key_rows in jobs.values()]
+        for future in as_completed(futures):
+            path, key, file_rows, row_count, min_date, max_date = future.result()
+            partitions.update_catalog(catalog, path, *key, row_count, min_date, max_date)
+            num_rows += file_rows
+    partitions.record_source(catalog, file_name, size, mtime, content_hash, [partitions.partition_name(*key) for key in groups])
+    catalog.commit()
+    return num_rows
+
+def addDictToPartitions(mode, folder_location, itin_dict, source_name, num_workers=4, pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    start = time.time()
+    size, mtime, content_hash = sourceSignature(folder_location, source_name, itin_dict)
+    catalog = partitions.open_catalog(folder_location, mode)
+    num_rows = writeSourceToPartitions(catalog, folder_location, mode, source_name, size, mtime, content_hash, itinRows(itin_dict),
+                                       num_workers, pragmas, batch_size)
+    catalog.close()
+    elapsed = time.time() - start
+    print(num_rows, "rows added to partitions in", round(elapsed, 2), "s (", int(num_rows/max(elapsed, 1e-9)), "rows/sec )")
+    return num_rows
+
+def createPartitionsFromDictFiles(mode, folder_location, num_workers=4, pragmas=INGEST_PRAGMAS, batch_size=INGEST_BATCH_SIZE):
+    start = time.time()
+    catalog = partitions.open_catalog(folder_location, mode)
+    all_files = dictFiles(folder_location, mode)
+    files = [f for f in all_files if not partitions.source_unchanged(catalog, f, *fileSignature(folder_location+f))]
+    num_rows = 0
+    for f in tqdm(files, desc='Partitioning Files'):
+        size, mtime = fileSignature(folder_location+f)
+        with open(folder_location+f, 'rb') as handle:
+            data = handle.read()
+        num_rows += writeSourceToPartitions(catalog, folder_location, mode, f, size, mtime, hashlib.sha256(data).hexdigest(),
+                                            itinRows(pickle.loads(data)), num_workers, pragmas, batch_size)
+    partitions.mark_backfilled(catalog)
+    catalog.commit()
+    catalog.close()
+    elapsed = time.time() - start
+    print(num_rows, "rows partitioned from", len(files), "new or changed files (", len(all_files)-len(files), "unchanged ) in", round(elapsed, 2), "s (",
+          int(num_rows/max(elapsed, 1e-9)), "rows/sec )")
+    return num_rows
+
+#route reader: a small SQLite index next to the pickles maps every origin/destination pair to
+#the files and keys holding it, refreshed only for files whose size/mtime changed. A route read
+#then unpickles just the files that contain it (a pickle can't be read partially) and builds the
+#frame once at the end
+ROUTE_INDEX_NAME = 'route_index.db'
+
+def openRouteIndex(folder_location):
+    conn = sqlite3.connect(folder_location+ROUTE_INDEX_NAME)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS route_index_files (
+        file_name TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime REAL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS route_index_keys (
+        file_name TEXT,
+        origin TEXT,
+        destination TEXT,
+        itin_key TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_route_index_route ON route_index_keys (origin, destination, file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_route_index_file ON route_index_keys (file_name)")
+    conn.commit()
+    return conn
+
+def refreshRouteIndex(conn, folder_location, files):
+    indexed = {f: (size, mtime) for f, size, mtime in conn.execute("SELECT file_name, size, mtime FROM route_index_files")}
+    num_indexed = 0
+    for f in set(indexed) - set(files):
+        conn.execute("DELETE FROM route_index_keys WHERE file_name=?", (f,))
+        conn.execute("DELETE FROM route_index_files WHERE file_name=?", (f,))
     for f in files:
+        size, mtime = fileSignature(folder_location+f)
+        if indexed.get(f) == (size, mtime):
+            continue
         with open(folder_location+f, 'rb') as handle:
-            itin_dict = pickle.load(handle) 
-            for key in init_dict:
-                if city_prefix1 not in key and city_prefix2 not in key:
-                    continue
-                data = pd.DataFrame(itin_dict[key])
-                if aggregateDf.empty:
-                    aggregateDf = data
-                else:
-                    aggregateDf = pd.concat([aggregateDf, data], axis=0, ignore_index=True)
-    return aggregateDf
+            itin_dict = pickle.load(handle)
+        conn.execute("DELETE FROM route_index_keys WHERE file_name=?", (f,))
+        conn.executemany("INSERT INTO route_index_keys (file_name, origin, destination, itin_key) VALUES (?, ?, ?, ?)",
+                         [(f,) + tuple(key.split('_')[:2]) + (key,) for key, itin in itin_dict.items() if not isEmpty(itin)])
+        conn.execute("INSERT OR REPLACE INTO route_index_files (file_name, size, mtime) VALUES (?, ?, ?)", (f, size, mtime))
+        conn.commit()
+        num_indexed+=1
+    conn.commit()
+    return num_indexed
+
+def streamRouteItins(origin, destination, folder_location, exclusion_list=[], both_directions=True):
+    #yields (file_name, key, itinerary) for every stored itinerary on the route, one file at a time.
+    #The index always covers every .pkl in the folder; exclusion_list only filters what is read, so
+    #calls with different exclusions don't drop and re-index each other's files
+    files = [f for f in listdir(folder_location) if isfile(join(folder_location, f)) and f.endswith('.pkl')]
+    conn = openRouteIndex(folder_location)
+    refreshRouteIndex(conn, folder_location, files)
+    routes = [(origin, destination), (destination, origin)] if both_directions else [(origin, destination)]
+    file_keys = {}
+    for route in routes:
+        for f, key in conn.execute("SELECT file_name, itin_key FROM route_index_keys WHERE origin=? AND destination=?", route):
+            if f not in exclusion_list:
+                file_keys.setdefault(f, []).append(key)
+    conn.close()
+    for f in sorted(file_keys):
+        with open(folder_location+f, 'rb') as handle:
+            itin_dict = pickle.load(handle)
+        wanted = set(file_keys[f])
+        for key, itin in itin_dict.items():
+            if key in wanted:
+                yield f, key, itin
+        del itin_dict
+
+def getAllFlightData(origin, destination, folder_location, exclusion_list):
+    rows = (row for f, key, itin in streamRouteItins(origin, destination, folder_location, exclusion_list) for row in itinRows({key: itin}))
+    return pd.DataFrame.from_records(rows, columns=dict_cats)
 
 def isEmpty(new_dict):
     if new_dict==0:
@@ -122,7 +744,7 @@ def isEmpty(new_dict):
     
 def repairPkl(folder_location, exclusion_list):
     files = [f for f in listdir(folder_location) if isfile(join(folder_location, f))]
-    files = [f for f in files if f not in exclusion_list and '.pkl' in f]
+    files = [f for f in files if f not in exclusion_list and f.endswith('.pkl')]
     num_entries=0
     for f in files:
         print(f)
@@ -131,7 +753,8 @@ def repairPkl(folder_location, exclusion_list):
             key_list = list(itin_dict.keys())
             for key in itin_dict:
                 new_dict = itin_dict[key]
-                if isEmpty(new_dict):
+                #entries written after the departure-date change already have "departure date"
+                if isEmpty(new_dict) or "departure year" not in new_dict:
                     continue
                 num_entries+=1
                 dep_date = key.split('_')[2]
@@ -147,16 +770,38 @@ def repairPkl(folder_location, exclusion_list):
         print(num_entries," entries repaired")
     
 
-def getItinDfFromAggDf(origin, destination, aggDf, duration, mode):
-    city_prefix1 = '_'.join([origin, destination])
-    city_prefix2 = '_'.join([destination, origin])
-    if mode=="domestic":
-        one_way_df = aggDf[(aggDf["origin"]==origin)&(aggDf["destination"]==destination)]
-        return_df = aggDf[(aggDf["origin"]==destination)&(aggDf["destination"]==origin)]
-        for index, row in one_way_df.iterrows():
-            dep_date = datetime.datetime.strptime(row["departure date"], "%Y-%m-%d")
-            target_date = (dep_date + datetime.timedelta(days=duration)).strftime('%Y-%m-%d')
-            return_flight = return_df[return_df["departure date"]==target_date]
+#round trips from one-way data: every outbound flight is paired with the inbound flights seen in
+#the same snapshot that leave duration days later. Dates become integer day numbers, the pairing is
+#one hash join over (snapshot, return day) for all durations at once, and only the top_k cheapest
+#combinations per departure date and duration are kept. Since a pair can only be among the top_k
+#if both of its legs are among the top_k of their own day, legs are cut to top_k before joining
+PAIR_LEG_COLUMNS = ["name", "price", "flight depart", "flight arrive", "flight duration", "stops", "stops info"]
+
+def cheapestLegs(leg_df, top_k):
+    leg_df = leg_df.assign(price_float=prices.extract_price_and_currency(leg_df.rename(columns={"departure date": "departure_date"}))["price_float"])
+    leg_df = leg_df.dropna(subset=["price_float", "day"])
+    return leg_df.sort_values("price_float", kind="stable").groupby(["today", "day"], sort=False).head(top_k)
+
+def getItinDfFromAggDf(origin, destination, aggDf, duration, mode, top_k=5):
+    durations = [duration] if np.isscalar(duration) else list(duration)
+    if mode!="domestic":
+        #intl itineraries are already round trips
+        itin_df = aggDf[(aggDf["origin"]==origin)&(aggDf["destination"]==destination)]
+        return itin_df[pd.to_numeric(itin_df["days"], errors='coerce').isin(durations)]
+    columns = ["origin", "destination", "days", "today", "departure date", "return date", "total price"] \
+        + PAIR_LEG_COLUMNS + [c+" return" for c in PAIR_LEG_COLUMNS]
+    if not durations:
+        return pd.DataFrame(columns=columns)
+    aggDf = aggDf.assign(day=(pd.to_datetime(aggDf["departure date"], errors='coerce') - pd.Timestamp(EPOCH_DATE)).dt.days)
+    one_way_df = cheapestLegs(aggDf[(aggDf["origin"]==origin)&(aggDf["destination"]==destination)], top_k)
+    return_df = cheapestLegs(aggDf[(aggDf["origin"]==destination)&(aggDf["destination"]==origin)], top_k)
+    outbound = pd.concat([one_way_df.assign(days=d, return_day=one_way_df["day"]+d) for d in durations], ignore_index=True)
+    pairs = outbound.merge(return_df[["today", "day", "departure date", "price_float"] + PAIR_LEG_COLUMNS],
+                           left_on=["today", "return_day"], right_on=["today", "day"], suffixes=("", " return"))
+    pairs["total price"] = pairs["price_float"] + pairs["price_float return"]
+    pairs = pairs.rename(columns={"departure date return": "return date"})
+    pairs = pairs.sort_values("total price", kind="stable").groupby(["today", "departure date", "days"], sort=False).head(top_k)
+    return pairs.sort_values(["today", "departure date", "days", "total price"], ignore_index=True)[columns]
 
 def modifyCaseChange(string):
     for i in range(1,len(string)):
@@ -199,11 +844,165 @@ def append_itin_to_dict(new_dict, fl, departure_date, origin, destination, days_
     new_dict["departure date"].append(departure_date)
     return new_dict
 
+#compact columnar buffer for one itinerary's results. origin, destination, days, today,
+#days ahead and departure date are the same for every flight of an itinerary so they are kept
+#once; the per-flight text columns hold interned strings (shared across the whole sweep and
+#pickled once per file) and stops is a typed array. Reads like the old dict-of-lists
+#(dict_cats order) and to_dict() exports exactly that shape. The compact form is in-memory only:
+#it pickles as that plain dict, so the day files, journals and queue results never depend on
+#this class
+class FlightColumns(Mapping):
+    __slots__ = ("origin", "destination", "days", "today", "days_ahead", "departure_date", "num_rows",
+                 "name", "price", "duration", "depart", "arrive", "stops", "stops_info")
+
+    def __init__(self, origin, destination, departure_date, days_ahead, days, today=None):
+        if today is None:
+            today = datetime.date.today().strftime('%Y-%m-%d')
+        self.origin = sys.intern(origin)
+        self.destination = sys.intern(destination)
+        self.departure_date = sys.intern(departure_date)
+        self.days_ahead = days_ahead
+        self.days = days
+        self.today = sys.intern(today)
+        self.num_rows = 0
+        self.name = []
+        self.price = []
+        self.duration = []
+        self.depart = []
+        self.arrive = []
+        self.stops = array('h')
+        self.stops_info = []
+
+    def append_flight(self, fl):
+        self.name.append(sys.intern(fl.name))
+        self.price.append(sys.intern(fl.price))
+        self.duration.append(sys.intern(fl.duration))
+        self.depart.append(sys.intern(fl.departure))
+        self.arrive.append(sys.intern(fl.arrival))
+        if isinstance(self.stops, array) and isinstance(fl.stops, int) and -32768 <= fl.stops < 32768:
+            self.stops.append(fl.stops)
+        else:
+            #non-numeric stops (eg "Unknown") fall back to a plain list
+            self.stops = list(self.stops)
+            self.stops.append(fl.stops)
+        self.stops_info.append(sys.intern(fl.stops_text))
+        self.num_rows+=1
+
+    def column(self, cat):
+        constants = {"origin": self.origin, "destination": self.destination, "days": self.days, "today": self.today,
+                     "days ahead": self.days_ahead, "departure date": self.departure_date}
+        if cat in constants:
+            return repeat(constants[cat], self.num_rows)
+        per_row = {"name": self.name, "price": self.price, "flight duration": self.duration, "flight depart": self.depart,
+                   "flight arrive": self.arrive, "stops": self.stops, "stops info": self.stops_info}
+        return iter(per_row[cat])
+
+    def __getitem__(self, cat):
+        if cat not in dict_cats:
+            raise KeyError(cat)
+        return list(self.column(cat))
+
+    def __iter__(self):
+        return iter(dict_cats)
+
+    def __len__(self):
+        return len(dict_cats)
+
+    def rows(self):
+        #row tuples in dict_cats order, without building the intermediate lists
+        return zip(*[self.column(cat) for cat in dict_cats])
+
+    def to_dict(self):
+        return {cat: self[cat] for cat in dict_cats}
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(),))
+
+def as_itin_dict(new_dict):
+    if isinstance(new_dict, FlightColumns):
+        return new_dict.to_dict()
+    return new_dict
+
 def save_prog(itin_dict, name):
-    with open(name, 'wb') as handle:
-        pickle.dump(itin_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)  
+    #write to a temp file and swap it in so a crash mid-write never leaves a torn pickle
+    with open(name+'.tmp', 'wb') as handle:
+        pickle.dump(itin_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(name+'.tmp', name)
 #     print("file updated")
 
+#append-only checkpoint journal next to the day's pickle: one length-prefixed
+#pickled (key, new_dict) record per finished itinerary, fsynced every `fsync_every` records
+JOURNAL_SUFFIX = '.journal'
+
+class ItinJournal:
+    def __init__(self, path, fsync_every=10):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.num_pending = 0
+        self.handle = open(path, 'ab')
+
+    def append(self, key, new_dict):
+        data = pickle.dumps((key, new_dict), protocol=pickle.HIGHEST_PROTOCOL)
+        self.handle.write(struct.pack('<I', len(data)) + data)
+        #hand the record to the OS right away so a killed process loses nothing; fsync is batched
+        self.handle.flush()
+        self.num_pending+=1
+        if self.num_pending >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.num_pending = 0
+
+    def close(self):
+        self.sync()
+        self.handle.close()
+
+def replay_journal(itin_dict, path):
+    #applies every complete record; a torn record at the tail (crash mid-append) is cut off
+    if not os.path.isfile(path):
+        return 0
+    num_records = 0
+    good_offset = 0
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    while good_offset + 4 <= len(data):
+        length = struct.unpack_from('<I', data, good_offset)[0]
+        end = good_offset + 4 + length
+        if end > len(data):
+            break
+        try:
+            key, new_dict = pickle.loads(data[good_offset+4:end])
+        except Exception:
+            break
+        itin_dict[key] = new_dict
+        num_records+=1
+        good_offset = end
+    if good_offset < len(data):
+        with open(path, 'r+b') as handle:
+            handle.truncate(good_offset)
+    return num_records
+
+def open_checkpoint(itin_dict, name, fsync_every=10):
+    #picks up results a crashed run left in the journal, then keeps appending to it
+    replay_journal(itin_dict, name+JOURNAL_SUFFIX)
+    return ItinJournal(name+JOURNAL_SUFFIX, fsync_every)
+
+def close_checkpoint(itin_dict, name, journal):
+    #compaction: fold everything into the pickle atomically, then drop the journal
+    journal.close()
+    save_prog(itin_dict, name)
+    os.remove(name+JOURNAL_SUFFIX)
+
+def load_itin_dict(name):
+    with open(name, 'rb') as handle:
+        itin_dict = pickle.load(handle)
+    replay_journal(itin_dict, name+JOURNAL_SUFFIX)
+    return itin_dict
+
 #for domestic, search all one-way and two-way itineraries
 def gen_itineraries(city_pairs, itin_type, num_days, num_itins=100):
     itin_list=[]
@@ -293,12 +1092,122 @@ def create_flight_filter(key, mode, origin, destination, departure_date, return_
         )
     return filter
 
-def get_flights_wrapper(filter, cookies):
-    result = get_flights(filter, cookies=cookies)
+#keep-alive session shared by every query of a sweep: `pool_size` host pools with up to
+#`per_host` open connections each, consent cookie set once on the session. Headers are left at
+#the requests defaults, the same ones fast_flights sends
+def create_flights_session(pool_size=10, per_host=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=per_host, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.cookies.update(CONSENT_COOKIES)
+    return session
+
+#on-disk cache of get_flights results keyed by the encoded flight filter.
+#entries older than `ttl` seconds are treated as misses, and once the cache holds more than
+#`max_entries` the least recently used ones are evicted
+class ResponseCache:
+    def __init__(self, path, ttl=6*3600, max_entries=50000, evict_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.puts_since_evict = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            created REAL,
+            accessed REAL,
+            result BLOB
+        )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_accessed ON response_cache (accessed)")
+        self.conn.commit()
+
+    @staticmethod
+    def filter_key(filter):
+        data = filter.as_b64()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, filter):
+        key = self.filter_key(filter)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT created, result FROM response_cache WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses+=1
+                return None
+            if now - row[0] > self.ttl:
+                self.conn.execute("DELETE FROM response_cache WHERE key=?", (key,))
+                self.conn.commit()
+                self.expired+=1
+                self.misses+=1
+                return None
+            self.conn.execute("UPDATE response_cache SET accessed=? WHERE key=?", (now, key))
+            self.conn.commit()
+            self.hits+=1
+        return pickle.loads(row[1])
+
+    def put(self, filter, result):
+        key = self.filter_key(filter)
+        now = time.time()
+        blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO response_cache (key, created, accessed, result) VALUES (?, ?, ?, ?)", (key, now, now, blob))
+            self.puts_since_evict+=1
+            if self.puts_since_evict >= self.evict_every:
+                self.puts_since_evict = 0
+                self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        cursor = self.conn.execute("DELETE FROM response_cache WHERE created < ?", (time.time()-self.ttl,))
+        self.evicted += cursor.rowcount
+        num_entries = self.conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+        if num_entries > self.max_entries:
+            cursor = self.conn.execute("DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache ORDER BY accessed ASC LIMIT ?)", (num_entries-self.max_entries,))
+            self.evicted += cursor.rowcount
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "expired": self.expired, "evicted": self.evicted,
+                "hit_rate": self.hits/lookups if lookups else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.evict()
+            self.conn.commit()
+            self.conn.close()
+
+def get_flights_wrapper(filter, session=None, cache=None):
+    if cache is not None:
+        result = cache.get(filter)
+        if result is not None:
+            return result
+    if session is None:
+        result = get_flights(filter, cookies=CONSENT_COOKIES)
+    else:
+        #get_flights opens a new connection per call and takes no session, so its GET is sent
+        #unchanged over the pooled one and parsed by fast_flights as usual
+        r = session.get(FLIGHTS_URL, params={"tfs": filter.as_b64(), "hl": "en", "tfu": "EgQIABABIgA"})
+        r.raise_for_status()
+        result = parse_response(r)
+    #empty results are not cached so they get retried
+    if cache is not None and result != [] and len(result.flights)>0:
+        cache.put(filter, result)
     return result
 
 def createDfAndPrint(data):
-    aggregateDf = pd.DataFrame(data)
+    #FlightColumns is a Mapping, not a dict, so pandas needs it exported first
+    aggregateDf = pd.DataFrame(as_itin_dict(data))
     with pd.option_context('display.max_colwidth', None,'display.max_rows', None):
         display(aggregateDf)    
         
@@ -308,8 +1217,104 @@ def gen_dict_from_itin(itin):
         dict1[i]=0
     return dict1
     
-def update_dict(itin_dict, folder_path, date_today_file, mode):
-    save_prog_count=0
+def parse_itin_key(key, mode):
+    if mode=="domestic":
+        origin, destination, departure_date = key.split('_')
+        return_date=0
+        days=''
+    else:
+        origin, destination, departure_date, return_date = key.split('_')
+        days = (datetime.datetime.strptime(return_date, "%Y-%m-%d") - \
+                datetime.datetime.strptime(departure_date, "%Y-%m-%d")).days
+    days_ahead = (datetime.datetime.strptime(departure_date, "%Y-%m-%d") - datetime.datetime.today()).days
+    return origin, destination, departure_date, return_date, days, days_ahead
+
+def fetch_itin(key, mode, session=None, cache=None):
+    #returns the filled itinerary dict, or 0 if the query came back empty
+    origin, destination, departure_date, return_date, days, days_ahead = parse_itin_key(key, mode)
+    filter = create_flight_filter(key, mode, origin, destination, departure_date, return_date)
+    result = get_flights_wrapper(filter, session, cache)
+    if result == [] or len(result.flights)==0:
+        return 0
+    new_dict = FlightColumns(origin, destination, departure_date, days_ahead, days)
+    for fl in result.flights:
+        new_dict.append_flight(fl)
+    return new_dict
+
+#token bucket: `rate` requests/sec with bursts of up to `capacity`
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        #takes a token (going into debt if needed) and returns how long to wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now-self.last)*self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens/self.rate
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+    async def wait_async(self):
+        await asyncio.sleep(self.reserve())
+
+#additive-increase/multiplicative-decrease limit on queries in flight.
+#empty results and errors count as failures; once the failure rate over the last
+#`window` queries goes above `max_failure_rate` the limit is cut by `decrease`
+class AIMDController:
+    def __init__(self, initial=4, min_limit=1, max_limit=32, increase=1, decrease=0.5, window=20, max_failure_rate=0.2):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.window = window
+        self.max_failure_rate = max_failure_rate
+        self.outcomes = deque(maxlen=window)
+        self.in_flight = 0
+        self.num_decreases = 0
+        self.cond = None
+
+    def record(self, ok):
+        self.outcomes.append(ok)
+        if ok:
+            #grows by `increase` per limit's worth of successes, ie roughly once per round of queries
+            self.limit = min(self.max_limit, self.limit + self.increase/self.limit)
+            return
+        failure_rate = self.outcomes.count(False)/len(self.outcomes)
+        if len(self.outcomes) >= min(self.window, self.limit) and failure_rate > self.max_failure_rate:
+            self.limit = max(self.min_limit, self.limit*self.decrease)
+            self.num_decreases+=1
+            #start a fresh window so one bad patch only cuts the limit once
+            self.outcomes.clear()
+
+    async def acquire(self):
+        if self.cond is None:
+            self.cond = asyncio.Condition()
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight+=1
+
+    async def release(self, ok):
+        async with self.cond:
+            self.in_flight-=1
+            self.record(ok)
+            self.cond.notify_all()
+
+def update_dict(itin_dict, folder_path, date_today_file, mode, rate_limiter=None, session=None, cache=None):
+    own_session = session is None
+    if own_session:
+        session = create_flights_session(pool_size=1, per_host=1)
+    journal = open_checkpoint(itin_dict, folder_path+date_today_file)
     num_unfinished=0
     total_keys = len(itin_dict.keys())
 #     f = IntProgress(min=0, max=100) # instantiate the bar
@@ -326,41 +1331,419 @@ def update_dict(itin_dict, folder_path, date_today_file, mode):
         key_num+=1
         if itin_dict[key]!=0:
             continue
-        if save_prog_count==10:
-            save_prog_count = 0
-            save_prog(itin_dict, folder_path+date_today_file)
-        start = time.time()
-        if mode=="domestic":
-            origin, destination, departure_date = key.split('_')
-            return_date=0
-            days=''
-        else:
-            origin, destination, departure_date, return_date = key.split('_')
-            days = (datetime.datetime.strptime(return_date, "%Y-%m-%d") - \
-                    datetime.datetime.strptime(departure_date, "%Y-%m-%d")).days
-        days_ahead = (datetime.datetime.strptime(departure_date, "%Y-%m-%d") - datetime.datetime.today()).days
-        new_dict={}
-        new_dict=initialize_dict(new_dict)
-        # Create a new filter
-        cookies = { "CONSENT": "YES+" }
-        filter = create_flight_filter(key, mode, origin, destination, departure_date, return_date)
-        result = get_flights_wrapper(filter, cookies)
-        if result == []:
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        new_dict = fetch_itin(key, mode, session, cache)
+        if isEmpty(new_dict):
             num_unfinished+=1
             continue
-        if len(result.flights)==0:
-            num_unfinished+=1
-            continue 
-        total_flights_found+= len(result.flights) 
+        total_flights_found+= new_dict.num_rows
         total_routes_searched+=1
-        for i in range(len(result.flights)):
-            fl = result.flights[i]
-            new_dict = append_itin_to_dict(new_dict, fl, departure_date,origin, destination, days_ahead,days)
         itin_dict[key] = new_dict
-        save_prog_count+=1
-        end = time.time()
+        journal.append(key, new_dict)
     progress_bar.close()
-    save_prog(itin_dict, folder_path+date_today_file)
+    if own_session:
+        session.close()
+    close_checkpoint(itin_dict, folder_path+date_today_file, journal)
     return num_unfinished
 
-    
\ No newline at end of file
+def backoff_delay(attempt, base_delay=2, max_delay=60):
+    #exponential backoff with equal jitter: half the delay is fixed, half is random
+    delay = min(max_delay, base_delay*(2**(attempt-1)))
+    return delay/2 + random.uniform(0, delay/2)
+
+#single-pass sweep with per-key retries: a key whose query fails is pushed back on a heap with
+#an exponential backoff instead of waiting for the next full pass over itin_dict, so finished
+#keys are never rescanned. Returns the keys that still failed after max_tries attempts
+def update_dict_retry(itin_dict, folder_path, date_today_file, mode, max_tries=3, base_delay=2, max_delay=60,
+                      rate_limiter=None, session=None, cache=None):
+    own_session = session is None
+    if own_session:
+        session = create_flights_session(pool_size=1, per_host=1)
+    journal = open_checkpoint(itin_dict, folder_path+date_today_file)
+    pending = [key for key in itin_dict if isEmpty(itin_dict[key])]
+    #fresh keys are taken in order; a failed key goes on the heap as (ready_at, order, attempt, key)
+    #and is retried as soon as it comes due, ahead of the remaining fresh keys. The loop only
+    #sleeps once every fresh key has had its first attempt
+    fresh_keys = deque(pending)
+    retry_heap = []
+    order = 0
+    progress_bar = tqdm(total=len(pending), desc='Processing')
+    failed_keys = []
+    total_flights_found=1
+    total_routes_searched = 1
+    while fresh_keys or retry_heap:
+        if retry_heap and (not fresh_keys or retry_heap[0][0] <= time.monotonic()):
+            ready_at, i, attempt, key = heapq.heappop(retry_heap)
+            wait = ready_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        else:
+            attempt, key = 1, fresh_keys.popleft()
+        if rate_limiter is not None:
+            rate_limiter.wait()
+        try:
+            new_dict = fetch_itin(key, mode, session, cache)
+        except Exception:
+            new_dict = 0
+        if isEmpty(new_dict):
+            if attempt < max_tries:
+                heapq.heappush(retry_heap, (time.monotonic()+backoff_delay(attempt, base_delay, max_delay), order, attempt+1, key))
+                order+=1
+            else:
+                failed_keys.append(key)
+                progress_bar.update(1)
+            continue
+        total_flights_found+= new_dict.num_rows
+        total_routes_searched+=1
+        itin_dict[key] = new_dict
+        progress_bar.update(1)
+        progress_bar.set_postfix_str(f'{total_flights_found/total_routes_searched}/{total_routes_searched} avg flights, {len(retry_heap)} retries queued')
+        journal.append(key, new_dict)
+    progress_bar.close()
+    if own_session:
+        session.close()
+    close_checkpoint(itin_dict, folder_path+date_today_file, journal)
+    return failed_keys
+
+#concurrent sweep: keeps up to `concurrency` queries in flight on a thread pool.
+#pass an AIMDController to let the limit adapt instead (up to its max_limit) and a
+#TokenBucket to cap requests/sec.
+#all workers share one pooled session, sized to the concurrency unless one is passed in.
+#in a notebook call `await helper.update_dict_async(...)`, elsewhere use update_dict_concurrent
+async def update_dict_async(itin_dict, folder_path, date_today_file, mode, concurrency=8, rate_limiter=None, controller=None, session=None, cache=None):
+    if controller is not None:
+        concurrency = controller.max_limit
+    own_session = session is None
+    if own_session:
+        session = create_flights_session(pool_size=1, per_host=concurrency)
+    journal = open_checkpoint(itin_dict, folder_path+date_today_file)
+    pending = [key for key in itin_dict if itin_dict[key]==0]
+    queue = asyncio.Queue()
+    for key in pending:
+        queue.put_nowait(key)
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    progress_bar = tqdm(total=len(pending), desc='Processing')
+    stats = {"num_unfinished":0, "total_flights_found":1, "total_routes_searched":1}
+
+    async def worker():
+        while True:
+            try:
+                key = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if controller is not None:
+                await controller.acquire()
+            if rate_limiter is not None:
+                await rate_limiter.wait_async()
+            try:
+                new_dict = await loop.run_in_executor(executor, fetch_itin, key, mode, session, cache)
+            except Exception:
+                new_dict = 0
+            if controller is not None:
+                await controller.release(not isEmpty(new_dict))
+            progress_bar.update(1)
+            if isEmpty(new_dict):
+                stats["num_unfinished"]+=1
+                continue
+            stats["total_flights_found"]+= new_dict.num_rows
+            stats["total_routes_searched"]+=1
+            postfix = f'{stats["total_flights_found"]/stats["total_routes_searched"]}/{stats["total_routes_searched"]} avg flights'
+            if controller is not None:
+                postfix += f', limit {int(controller.limit)}'
+            progress_bar.set_postfix_str(postfix)
+            itin_dict[key] = new_dict
+            journal.append(key, new_dict)
+
+    try:
+        await asyncio.gather(*[worker() for i in range(concurrency)])
+    finally:
+        executor.shutdown(wait=True)
+        if own_session:
+            session.close()
+        progress_bar.close()
+        close_checkpoint(itin_dict, folder_path+date_today_file, journal)
+    return stats["num_unfinished"]
+
+def update_dict_concurrent(itin_dict, folder_path, date_today_file, mode, concurrency=8, rate_limiter=None, controller=None, session=None, cache=None):
+    return asyncio.run(update_dict_async(itin_dict, folder_path, date_today_file, mode, concurrency, rate_limiter, controller, session, cache))
+
+#sharded sweep: keys are split across worker processes by a stable hash, each worker
+#checkpoints to its own file under folder_path/shards/ (so createDBFromDictFiles never
+#picks them up) and the shards are merged back into itin_dict at the end
+def shard_of(key, num_shards):
+    return zlib.crc32(key.encode("utf-8")) % num_shards
+
+def shard_file_name(date_today_file, shard, num_shards):
+    base, ext = os.path.splitext(date_today_file)
+    return 'shards/' + base + '_shard' + str(shard) + 'of' + str(num_shards) + ext
+
+def shard_itin_dict(itin_dict, num_shards):
+    shards = [{} for i in range(num_shards)]
+    for key in itin_dict:
+        shards[shard_of(key, num_shards)][key] = itin_dict[key]
+    return shards
+
+def run_sweep_shard(shard_dict, folder_path, shard_file, mode, max_tries, concurrency):
+    #resume from the shard's own checkpoint if this shard already ran today
+    if os.path.isfile(folder_path+shard_file):
+        saved_dict = load_itin_dict(folder_path+shard_file)
+        for key in shard_dict:
+            if isEmpty(shard_dict[key]) and key in saved_dict:
+                shard_dict[key] = saved_dict[key]
+    num_unfinished = 0
+    for i in range(max_tries):
+        if concurrency > 1:
+            num_unfinished = update_dict_concurrent(shard_dict, folder_path, shard_file, mode, concurrency)
+        else:
+            num_unfinished = update_dict(shard_dict, folder_path, shard_file, mode)
+        if num_unfinished==0:
+            break
+    return num_unfinished
+
+def merge_shard_files(itin_dict, folder_path, date_today_file, num_shards):
+    for shard in range(num_shards):
+        shard_file = shard_file_name(date_today_file, shard, num_shards)
+        if not os.path.isfile(folder_path+shard_file):
+            continue
+        with open(folder_path+shard_file, 'rb') as handle:
+            shard_dict = pickle.load(handle)
+        for key, new_dict in shard_dict.items():
+            if key in itin_dict and not isEmpty(new_dict):
+                itin_dict[key] = new_dict
+    save_prog(itin_dict, folder_path+date_today_file)
+    return itin_dict
+
+def update_dict_sharded(itin_dict, folder_path, date_today_file, mode, num_shards=None, max_tries=3, concurrency=1):
+    if num_shards is None:
+        num_shards = os.cpu_count() or 1
+    os.makedirs(folder_path+'shards', exist_ok=True)
+    shards = shard_itin_dict(itin_dict, num_shards)
+    shard_files = [shard_file_name(date_today_file, i, num_shards) for i in range(num_shards)]
+    with ProcessPoolExecutor(max_workers=num_shards) as pool:
+        results = list(pool.map(run_sweep_shard, shards, [folder_path]*num_shards, shard_files,
+                                [mode]*num_shards, [max_tries]*num_shards, [concurrency]*num_shards))
+    merge_shard_files(itin_dict, folder_path, date_today_file, num_shards)
+    return sum(results)
+
+#SQLite work queue: one row per itinerary key with status (pending/leased/done/failed),
+#lease owner/expiry and attempt count. Workers claim batches inside a BEGIN IMMEDIATE
+#transaction, results are written back to the row as soon as each key finishes, and leases
+#that expire are handed out again. A worker renews its leases before each query and only
+#writes back rows it still holds, so a worker that lost a lease can't overwrite another's
+#result. The default WAL journal only works for processes on one
+#host; for workers on several machines sharing the file over a network mount pass
+#journal_mode="DELETE" (the rollback journal), which relies on that filesystem's file locking
+QUEUE_JOURNAL_MODE = "WAL"
+
+def open_work_queue(queue_path, journal_mode=QUEUE_JOURNAL_MODE):
+    conn = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    conn.execute(f"PRAGMA journal_mode={journal_mode}")
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS work_queue (
+        key TEXT PRIMARY KEY,
+        mode TEXT,
+        status TEXT,
+        lease_owner TEXT,
+        lease_expiry REAL,
+        attempts INTEGER,
+        result BLOB,
+        updated REAL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_work_queue_status ON work_queue (status, lease_expiry)")
+    return conn
+
+def enqueue_itineraries(conn, itin_dict, mode):
+    now = time.time()
+    rows = []
+    for key, new_dict in itin_dict.items():
+        if isEmpty(new_dict):
+            rows.append((key, mode, 'pending', None, now))
+        else:
+            rows.append((key, mode, 'done', pickle.dumps(new_dict, protocol=pickle.HIGHEST_PROTOCOL), now))
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("INSERT OR IGNORE INTO work_queue (key, mode, status, attempts, result, updated) VALUES (?, ?, ?, 0, ?, ?)", rows)
+    conn.execute("COMMIT")
+
+def claim_batch(conn, worker_id, batch_size=20, lease_seconds=300, max_attempts=3):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        #expired leases that already used up their attempts are given up on
+        conn.execute("UPDATE work_queue SET status='failed', lease_owner=NULL, updated=? WHERE status='leased' AND lease_expiry<? AND attempts>=?",
+                     (now, now, max_attempts))
+        rows = conn.execute("SELECT key, mode FROM work_queue WHERE status='pending' OR (status='leased' AND lease_expiry<?) ORDER BY rowid LIMIT ?",
+                            (now, batch_size)).fetchall()
+        conn.executemany("UPDATE work_queue SET status='leased', lease_owner=?, lease_expiry=?, attempts=attempts+1, updated=? WHERE key=?",
+                         [(worker_id, now+lease_seconds, now, key) for key, mode in rows])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+def renew_leases(conn, worker_id, lease_seconds=300):
+    #extends every lease the worker still holds and returns those keys
+    conn.execute("UPDATE work_queue SET lease_expiry=? WHERE lease_owner=? AND status='leased'", (time.time()+lease_seconds, worker_id))
+    return {key for (key,) in conn.execute("SELECT key FROM work_queue WHERE lease_owner=? AND status='leased'", (worker_id,))}
+
+#both return False, writing nothing, when worker_id no longer holds the key's lease
+def complete_itin(conn, key, new_dict, worker_id):
+    cursor = conn.execute("UPDATE work_queue SET status='done', result=?, lease_owner=NULL, lease_expiry=NULL, updated=? "
+                          "WHERE key=? AND lease_owner=? AND status='leased'",
+                          (pickle.dumps(new_dict, protocol=pickle.HIGHEST_PROTOCOL), time.time(), key, worker_id))
+    return cursor.rowcount==1
+
+def fail_itin(conn, key, worker_id, max_attempts=3):
+    cursor = conn.execute("UPDATE work_queue SET status=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END, lease_owner=NULL, lease_expiry=NULL, updated=? "
+                          "WHERE key=? AND lease_owner=? AND status='leased'",
+                          (max_attempts, time.time(), key, worker_id))
+    return cursor.rowcount==1
+
+def queue_status(conn):
+    return dict(conn.execute("SELECT status, COUNT(*) FROM work_queue GROUP BY status").fetchall())
+
+def queue_to_itin_dict(conn):
+    itin_dict = {}
+    for key, status, result in conn.execute("SELECT key, status, result FROM work_queue ORDER BY rowid"):
+        itin_dict[key] = pickle.loads(result) if status=='done' else 0
+    return itin_dict
+
+def run_queue_worker(queue_path, worker_id=None, batch_size=20, lease_seconds=300, max_attempts=3, rate_limiter=None, cache=None,
+                     journal_mode=QUEUE_JOURNAL_MODE):
+    if worker_id is None:
+        worker_id = socket.gethostname() + '-' + str(os.getpid()) + '-' + uuid.uuid4().hex[:8]
+    conn = open_work_queue(queue_path, journal_mode)
+    session = create_flights_session(pool_size=1, per_host=1)
+    num_done = 0
+    num_failed = 0
+    try:
+        while True:
+            batch = claim_batch(conn, worker_id, batch_size, lease_seconds, max_attempts)
+            if len(batch)==0:
+                break
+            for key, mode in batch:
+                if key not in renew_leases(conn, worker_id, lease_seconds):
+                    #the lease ran out and the key was handed to another worker
+                    continue
+                if rate_limiter is not None:
+                    rate_limiter.wait()
+                try:
+                    new_dict = fetch_itin(key, mode, session, cache)
+                except Exception:
+                    new_dict = 0
+                if isEmpty(new_dict):
+                    if fail_itin(conn, key, worker_id, max_attempts):
+                        num_failed+=1
+                elif complete_itin(conn, key, new_dict, worker_id):
+                    num_done+=1
+    finally:
+        session.close()
+        conn.close()
+    return num_done, num_failed
+
+def run_queue_workers(queue_path, num_workers=None, batch_size=20, lease_seconds=300, max_attempts=3, journal_mode=QUEUE_JOURNAL_MODE):
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        futures = [pool.submit(run_queue_worker, queue_path, None, batch_size, lease_seconds, max_attempts, None, None, journal_mode)
+                   for i in range(num_workers)]
+        results = [f.result() for f in futures]
+    conn = open_work_queue(queue_path, journal_mode)
+    status = queue_status(conn)
+    conn.close()
+    return status
+
+#priority scheduler: scores every key from how soon it departs, how long since it was last
+#observed and how much its cheapest fare has moved between snapshots in data_table, so the
+#sweep hits the most useful itineraries first
+def itin_history(DB_filename, mode, folder_location):
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
+    cursor = createInitialDBTable(cursor)
+    conn.commit()
+    query = """
+    SELECT origin, destination, departure_date, days, MAX(today), COUNT(*), AVG(min_price), AVG(min_price*min_price)
+    FROM (
+        SELECT origin, destination, departure_date, days, today, MIN(price_minor) AS min_price
+        FROM data_table
+        GROUP BY origin, destination, departure_date, days, today
+    )
+    WHERE min_price IS NOT NULL
+    GROUP BY origin, destination, departure_date, days
+    """
+    history = {}
+    for origin, destination, departure_date, days, last_seen, num_obs, mean, mean_sq in cursor.execute(query):
+        history[(origin, destination, departure_date, str(days))] = (last_seen, num_obs, mean, mean_sq)
+    conn.close()
+    return history
+
+def score_itineraries(itin_dict, mode, history, w_urgency=1.0, w_staleness=1.0, w_volatility=1.0):
+    today = datetime.datetime.today()
+    scores = {}
+    for key in itin_dict:
+        origin, destination, departure_date, return_date, days, days_ahead = parse_itin_key(key, mode)
+        urgency = 1/(1 + max(days_ahead, 0)/30)
+        obs = history.get((origin, destination, departure_date, str(days)))
+        if obs is None:
+            #never seen: as stale and as uncertain as it gets
+            staleness = 1.0
+            volatility = 1.0
+        else:
+            last_seen, num_obs, mean, mean_sq = obs
+            days_since = (today - datetime.datetime.strptime(last_seen, "%Y-%m-%d")).days
+            staleness = min(max(days_since, 0)/7, 1.0)
+            variance = max(mean_sq - mean*mean, 0)
+            volatility = min(np.sqrt(variance)/mean, 1.0) if num_obs>1 and mean>0 else 0.5
+        scores[key] = w_urgency*urgency + w_staleness*staleness + w_volatility*volatility
+    return scores
+
+def prioritize_itin_dict(itin_dict, mode, DB_filename, folder_location, **weights):
+    history = itin_history(DB_filename, mode, folder_location)
+    scores = score_itineraries(itin_dict, mode, history, **weights)
+    ordered_keys = sorted(itin_dict, key=lambda key: scores[key], reverse=True)
+    return {key: itin_dict[key] for key in ordered_keys}
+
+def itin_key(origin, destination, departure_date, days, mode):
+    if mode=="domestic":
+        return '_'.join([origin, destination, departure_date])
+    return_date = (datetime.datetime.strptime(departure_date, "%Y-%m-%d") + datetime.timedelta(days=int(days))).strftime('%Y-%m-%d')
+    return '_'.join([origin, destination, departure_date, return_date])
+
+#incremental refresh: a key is stable when its cheapest fare was identical in each of its last
+#`k` snapshots and the newest of those is at most `max_age_days` old. Stable keys are left out
+#of today's sweep; anything older than max_age_days is always refreshed
+def stable_itin_keys(DB_filename, mode, folder_location, k=3, max_age_days=7):
+    conn, cursor = returnDBFromFile(DB_filename, mode, folder_location)
+    cursor = createInitialDBTable(cursor)
+    conn.commit()
+    query = """
+    SELECT origin, destination, departure_date, days, today, min_price FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY origin, destination, departure_date, days ORDER BY today DESC) AS snapshot_num
+        FROM (
+            SELECT origin, destination, departure_date, days, today, MIN(price_minor) AS min_price
+            FROM data_table
+            GROUP BY origin, destination, departure_date, days, today
+        )
+    )
+    WHERE snapshot_num <= ?
+    """
+    snapshots = {}
+    for origin, destination, departure_date, days, today, min_price in cursor.execute(query, (k,)):
+        snapshots.setdefault((origin, destination, departure_date, days), []).append((today, min_price))
+    conn.close()
+    oldest_allowed = (datetime.datetime.today() - datetime.timedelta(days=max_age_days)).strftime('%Y-%m-%d')
+    stable = set()
+    for (origin, destination, departure_date, days), obs in snapshots.items():
+        if len(obs) < k or max(today for today, min_price in obs) < oldest_allowed:
+            continue
+        prices = set(min_price for today, min_price in obs)
+        if len(prices)==1 and None not in prices:
+            stable.add(itin_key(origin, destination, departure_date, days, mode))
+    return stable
+
+def incremental_itin_dict(itin, DB_filename, mode, folder_location, k=3, max_age_days=7):
+    stable = stable_itin_keys(DB_filename, mode, folder_location, k, max_age_days)
+    itin_dict = gen_dict_from_itin([key for key in itin if key not in stable])
+    print(len(itin)-len(itin_dict), "/", len(itin), " itineraries skipped as stable")
+    return itin_dict
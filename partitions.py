@@ -0,0 +1,158 @@
+import sqlite3
+import os
+import shutil
+import datetime
+
+#one SQLite file per route and departure month under <folder>/partitions/<mode>/,
+#plus a catalog DB listing every partition with its date bounds so readers open only
+#the files that can match a query. Kept free of the scraping dependencies so app.py can
+#import it; the partition files themselves use helper's data_table schema.
+PARTITION_DIR = "partitions"
+CATALOG_NAME = "catalog.db"
+ARCHIVE_DIR = "archive"
+
+def partition_root(folder_location, mode):
+    return os.path.join(folder_location, PARTITION_DIR, mode)
+
+def partition_month(departure_date):
+    #'2026-03-14' -> '2026-03'
+    return str(departure_date)[:7]
+
+def partition_name(origin, destination, month):
+    #relative to partition_root; this is what the catalog stores
+    return os.path.join(f"{origin}_{destination}", f"{month}.db")
+
+def open_catalog(folder_location, mode):
+    root = partition_root(folder_location, mode)
+    os.makedirs(root, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(root, CATALOG_NAME), timeout=60)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS partitions (
+        path TEXT PRIMARY KEY,
+        origin TEXT,
+        destination TEXT,
+        month TEXT,
+        min_date TEXT,
+        max_date TEXT,
+        row_count INTEGER,
+        updated_at TEXT,
+        archived INTEGER DEFAULT 0
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_partitions_route ON partitions (origin, destination, month)")
+    #source files already split into partitions, so unchanged day files are skipped on re-runs
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS sources (
+        file_name TEXT PRIMARY KEY,
+        size INTEGER,
+        mtime REAL,
+        content_hash TEXT
+    )
+    ''')
+    #which partitions each source file wrote to, so a changed file can clear months it no longer covers
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS source_partitions (
+        file_name TEXT,
+        path TEXT,
+        PRIMARY KEY (file_name, path)
+    )
+    ''')
+    #catalog flags; 'backfilled' is set once every existing day file has been partitioned
+    conn.execute("CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+    return conn
+
+def mark_backfilled(catalog):
+    catalog.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('backfilled', '1')")
+    return catalog
+
+def is_backfilled(folder_location, mode):
+    #until the history is backfilled the partitions only hold recent days, so readers should
+    #keep using the single per-mode DB
+    if not catalog_exists(folder_location, mode):
+        return False
+    conn = open_catalog(folder_location, mode)
+    entry = conn.execute("SELECT value FROM catalog_meta WHERE key='backfilled'").fetchone()
+    conn.close()
+    return entry is not None and entry[0]=='1'
+
+def source_unchanged(catalog, file_name, size, mtime):
+    entry = catalog.execute("SELECT size, mtime FROM sources WHERE file_name=?", (file_name,)).fetchone()
+    return entry is not None and size is not None and entry[0]==size and entry[1]==mtime
+
+def source_partition_keys(catalog, file_name):
+    #{path: (origin, destination, month)} for the partitions the source wrote last time
+    return {path: (origin, destination, month) for path, origin, destination, month in catalog.execute('''
+    SELECT p.path, p.origin, p.destination, p.month FROM source_partitions s JOIN partitions p ON p.path = s.path
+    WHERE s.file_name=?
+    ''', (file_name,)).fetchall()}
+
+def record_source(catalog, file_name, size, mtime, content_hash, paths):
+    catalog.execute("INSERT OR REPLACE INTO sources (file_name, size, mtime, content_hash) VALUES (?, ?, ?, ?)",
+                    (file_name, size, mtime, content_hash))
+    catalog.execute("DELETE FROM source_partitions WHERE file_name=?", (file_name,))
+    catalog.executemany("INSERT INTO source_partitions (file_name, path) VALUES (?, ?)", [(file_name, path) for path in paths])
+    return catalog
+
+def update_catalog(catalog, path, origin, destination, month, row_count, min_date, max_date):
+    catalog.execute('''
+    INSERT INTO partitions (path, origin, destination, month, min_date, max_date, row_count, updated_at, archived)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+    ON CONFLICT (path) DO UPDATE SET min_date=excluded.min_date, max_date=excluded.max_date,
+        row_count=excluded.row_count, updated_at=excluded.updated_at, archived=0
+    ''', (path, origin, destination, month, min_date, max_date, row_count, datetime.datetime.now().isoformat(timespec='seconds')))
+    return catalog
+
+def catalog_exists(folder_location, mode):
+    return os.path.isfile(os.path.join(partition_root(folder_location, mode), CATALOG_NAME))
+
+def find_partitions(folder_location, mode, origin=None, destination=None, start_date=None, end_date=None):
+    #partition pruning: returns the absolute paths of the live partitions that can hold rows
+    #for the route and departure date range, in month order
+    if not catalog_exists(folder_location, mode):
+        return []
+    query = "SELECT path FROM partitions WHERE archived=0 AND row_count > 0"
+    params = []
+    if origin:
+        query += " AND origin = ?"
+        params.append(origin)
+    if destination:
+        query += " AND destination = ?"
+        params.append(destination)
+    if start_date:
+        query += " AND max_date >= ?"
+        params.append(str(start_date))
+    if end_date:
+        query += " AND min_date <= ?"
+        params.append(str(end_date))
+    query += " ORDER BY month, origin, destination"
+    conn = open_catalog(folder_location, mode)
+    paths = [row[0] for row in conn.execute(query, params).fetchall()]
+    conn.close()
+    root = partition_root(folder_location, mode)
+    return [os.path.join(root, path) for path in paths]
+
+def find_route_mode(folder_location, origin, destination, modes=("domestic", "intl")):
+    #which mode's backfilled catalog holds the route, or None
+    for mode in modes:
+        if is_backfilled(folder_location, mode) and find_partitions(folder_location, mode, origin, destination):
+            return mode
+    return None
+
+def archive_partitions(folder_location, mode, before_month):
+    #moves partitions whose departure month is before before_month ('YYYY-MM') out of the live
+    #tree; nothing else is rewritten and the catalog keeps them marked as archived
+    root = partition_root(folder_location, mode)
+    archive_root = os.path.join(root, ARCHIVE_DIR)
+    conn = open_catalog(folder_location, mode)
+    paths = [row[0] for row in conn.execute("SELECT path FROM partitions WHERE archived=0 AND month < ?", (before_month,)).fetchall()]
+    for path in paths:
+        target = os.path.join(archive_root, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(os.path.join(root, path) + suffix):
+                shutil.move(os.path.join(root, path) + suffix, target + suffix)
+        conn.execute("UPDATE partitions SET archived=1 WHERE path=?", (path,))
+    conn.commit()
+    conn.close()
+    return len(paths)
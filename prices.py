@@ -0,0 +1,76 @@
+import re
+import json
+import functools
+import numpy as np
+import pandas as pd
+
+#price strings as scraped ("$1,234", "CA$99", "120 €", "USD 80") -> integer minor units plus an
+#ISO currency code. Shared by helper (ingest), app.py and the Analyzer notebook
+CURRENCY_SYMBOLS = {"$": "USD", "US$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY", "₹": "INR", "CA$": "CAD",
+                    "A$": "AUD", "MX$": "MXN", "E£": "EGP", "R$": "BRL", "HK$": "HKD", "NZ$": "NZD", "₩": "KRW"}
+ZERO_DECIMAL_CURRENCIES = {"JPY", "KRW"}
+PRICE_RE = re.compile(r'^\s*([^\d\s.,]*)\s*(\d[\d,]*(?:\.\d+)?)\s*([^\d\s.,]*)\s*$')
+BASE_CURRENCY = "USD"
+#units of BASE_CURRENCY per unit of each currency; override with load_fx_table() from a local
+#JSON file such as {"EUR": 1.09, "GBP": 1.27}
+FX_RATES = {"USD": 1.0, "EUR": 1.08, "GBP": 1.27, "CAD": 0.73, "AUD": 0.66, "MXN": 0.055, "INR": 0.012,
+            "JPY": 0.0067, "KRW": 0.00073, "EGP": 0.021, "BRL": 0.18, "HKD": 0.128, "NZD": 0.60}
+
+def currency_exponent(currency):
+    return 0 if currency in ZERO_DECIMAL_CURRENCIES else 2
+
+@functools.lru_cache(maxsize=None)
+def parse_price(price):
+    #"$1,234" -> (123400, "USD"); currency symbol or code may lead or trail the number
+    m = PRICE_RE.match(str(price))
+    if m is None:
+        return None, None
+    symbol = m.group(1) or m.group(3)
+    currency = CURRENCY_SYMBOLS.get(symbol)
+    if currency is None and len(symbol)==3 and symbol.isalpha():
+        currency = symbol.upper()
+    return int(round(float(m.group(2).replace(',', ''))*10**currency_exponent(currency))), currency
+
+def load_fx_table(path):
+    with open(path) as handle:
+        rates = {currency.upper(): float(rate) for currency, rate in json.load(handle).items()}
+    FX_RATES.update(rates)
+    return FX_RATES
+
+def parse_prices(prices):
+    #vectorized parse_price: each distinct string is parsed once and the results are broadcast
+    #back with the factorize codes, so the cost scales with the number of unique prices
+    codes, uniques = pd.factorize(prices, use_na_sentinel=True)
+    parsed = [parse_price(price) for price in uniques]
+    minor = np.array([np.nan if p[0] is None else p[0] for p in parsed] + [np.nan], dtype=float)
+    currency = np.array([p[1] for p in parsed] + [None], dtype=object)
+    #NA prices have code -1, which picks the trailing NaN/None
+    return pd.DataFrame({"price_minor": pd.array(minor[codes], dtype="Int64"), "currency": currency[codes]},
+                        index=prices.index)
+
+def to_base_currency(price_minor, currency, fx_rates=None):
+    #minor units in their own currency -> float amount in BASE_CURRENCY; unknown currencies
+    #(and a missing symbol, which the scraper only emits for USD) are treated as BASE_CURRENCY
+    fx_rates = FX_RATES if fx_rates is None else fx_rates
+    currency = pd.Series(currency, index=price_minor.index).fillna(BASE_CURRENCY)
+    rate = currency.map(fx_rates).fillna(1.0).to_numpy(dtype=float)
+    scale = np.where(currency.isin(ZERO_DECIMAL_CURRENCIES).to_numpy(), 1.0, 100.0)
+    return price_minor.to_numpy(dtype=float, na_value=np.nan) / scale * rate
+
+def base_price_sql(price_column="price_minor", currency_column="currency", fx_rates=None):
+    #the same conversion as a SQL expression, so queries over the typed columns can filter and
+    #sort on the normalized price
+    fx_rates = FX_RATES if fx_rates is None else fx_rates
+    cases = ' '.join(f"WHEN '{currency}' THEN {rate/10**currency_exponent(currency)!r}" for currency, rate in sorted(fx_rates.items()))
+    return f"({price_column} * CASE {currency_column} {cases} ELSE 0.01 END)"
+
+def extract_price_and_currency(df, fx_rates=None):
+    #adds currency, price_minor and price_float (in BASE_CURRENCY), drops rows whose price or
+    #departure date can't be parsed
+    parsed = parse_prices(df['price'])
+    df = df.assign(price_minor=parsed['price_minor'], currency=parsed['currency'])
+    df = df.dropna(subset=['price_minor'])
+    df['price_float'] = to_base_currency(df['price_minor'], df['currency'], fx_rates)
+    df['departure_date'] = pd.to_datetime(df['departure_date'], errors='coerce')
+    df = df.dropna(subset=['departure_date'])
+    return df